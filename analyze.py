@@ -71,23 +71,8 @@ out['vocab'] = v.vocabulary_
 out['idf'] = v._tfidf.idf_
 out['pids'] = pids  # a full idvv string (id and version number)
 out['ptoi'] = {x: i for i, x in enumerate(pids)}  # pid to ix in X mapping
+out['keys'] = txt_paths  # db key of every row of X
 print("writing", Config.meta_path)
 safe_pickle_dump(out, Config.meta_path)
 
-'''
-print("precomputing nearest neighbor queries in batches...")
-X = X.todense()  # originally it's a sparse matrix
-sim_dict = {}
-batch_size = 1000
-for i in range(0, len(pids), batch_size):
-    i1 = min(len(pids), i+batch_size)
-    xquery = X[i:i1]  # BxD
-    ds = -np.asarray(np.dot(X, xquery.T))  # NxD * DxB => NxB
-    IX = np.argsort(ds, axis=0)  # NxB
-    for j in range(i1-i):
-        sim_dict[pids[i+j]] = [pids[q] for q in list(IX[:50, j])]
-    print('%d/%d...' % (i, len(pids)))
-
-print("writing", Config.sim_path)
-safe_pickle_dump(sim_dict, Config.sim_path)
-'''
\ No newline at end of file
+# the similar papers of every paper are precomputed from X by make_sim.py
@@ -0,0 +1,178 @@
+"""
+approximate nearest neighbor index for paper similarity, used by serve.py
+(with --ann) instead of the exact neighbors of make_sim.py.
+
+an IVF style index for the cosine similarity: the vectors are clustered
+with spherical k-means into num_lists lists, and a query only reranks the
+papers of the nprobe lists whose centroids are closest to it, with the exact
+similarity. vectors can be the tfidf rows or the LSA embeddings, sparse or
+dense, and are expected to be l2 normalized.
+
+the rows are kept sorted by list, so a list is one contiguous slice. new
+papers can be added without rebuilding: they are assigned to their closest
+list and go into a small delta buffer that queries scan too, and merge()
+folds the buffer into the sorted lists.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+def _ranges(lo, hi):
+    """ concatenation of np.arange(a, b) for every a, b in zip(lo, hi) """
+    lens = hi - lo
+    starts = np.repeat(lo - np.cumsum(lens) + lens, lens)
+    return starts + np.arange(lens.sum())
+
+
+def _vstack(blocks):
+    if sparse.issparse(blocks[0]):
+        return sparse.vstack(blocks, format='csr')
+    return np.vstack(blocks)
+
+
+def _dense(a):
+    return np.asarray(a.toarray() if sparse.issparse(a) else a, dtype=np.float32)
+
+
+def _normalize(C):
+    norms = np.linalg.norm(C, axis=1, keepdims=True)
+    return C / np.maximum(norms, 1e-12)
+
+
+def train_centroids(vectors, num_lists, iters=10, sample=50000, seed=1337):
+    """ spherical k-means on a sample of the rows, returns (num_lists, dim) unit centroids """
+    rng = np.random.default_rng(seed)
+    n = vectors.shape[0]
+    S = vectors[np.sort(rng.choice(n, size=min(n, sample), replace=False))]
+    num_lists = min(num_lists, S.shape[0])
+    C = _normalize(_dense(S[rng.choice(S.shape[0], size=num_lists, replace=False)]))
+    for _ in range(iters):
+        assign = np.asarray(np.argmax(S @ np.ascontiguousarray(C.T), axis=1)).ravel()
+        onehot = sparse.csr_matrix((np.ones(len(assign), dtype=np.float32), (assign, np.arange(len(assign)))),
+                                   shape=(num_lists, S.shape[0]))
+        sums = _dense(onehot @ S)
+        # empty lists keep their old centroid
+        empty = np.asarray(onehot.sum(axis=1)).ravel() == 0
+        sums[empty] = C[empty]
+        C = _normalize(sums)
+    return C
+
+
+class IVFIndex(object):
+    """
+    keys are the db keys of the vectors. nprobe is the default number of
+    lists a query looks into, more means better recall but slower queries.
+    """
+
+    def __init__(self, num_lists=1024, nprobe=16):
+        self.num_lists = num_lists
+        self.nprobe = nprobe
+        self.centroids = None  # (dim, num_lists), transposed so products need no copy
+        self.keys = []
+        self.row = {}  # key -> row
+        # merged rows, sorted by list: list i is order[offsets[i]:offsets[i+1]]
+        self.vectors = None
+        self.order = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        # rows added since the last merge, and their lists
+        self.delta_vectors = []
+        self.delta_lists = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def assign(self, vectors, block_size=10000):
+        """ closest list of every row of vectors """
+        out = [np.zeros(0, dtype=np.int64)]
+        for i in range(0, vectors.shape[0], block_size):
+            s = vectors[i:i + block_size] @ self.centroids
+            out.append(np.asarray(np.argmax(s, axis=1)).ravel())
+        return np.concatenate(out)
+
+    def add(self, vectors, keys):
+        """ adds new vectors into the delta buffer. keys we already have are skipped """
+        new = [i for i, k in enumerate(keys) if k not in self.row]
+        if not new:
+            return 0
+        vectors = vectors[new]
+        for i in new:
+            self.row[keys[i]] = len(self.keys)
+            self.keys.append(keys[i])
+        self.delta_vectors.append(vectors)
+        self.delta_lists = np.concatenate([self.delta_lists, self.assign(vectors)])
+        return len(new)
+
+    def merge(self):
+        """ folds the delta buffer into the sorted lists """
+        if not self.delta_vectors:
+            return
+        blocks = ([self.vectors] if self.vectors is not None else []) + self.delta_vectors
+        self.vectors = _vstack(blocks)
+        lists = np.zeros(len(self.order), dtype=np.int64)
+        lists[self.order] = np.repeat(np.arange(self.num_lists), np.diff(self.offsets))
+        lists = np.concatenate([lists, self.delta_lists])
+        self.order = np.argsort(lists, kind='stable')
+        np.cumsum(np.bincount(lists, minlength=self.num_lists), out=self.offsets[1:])
+        self.delta_vectors = []
+        self.delta_lists = np.zeros(0, dtype=np.int64)
+
+    def build(self, vectors, keys):
+        """ trains the centroids on vectors, then adds all of them and sorts them into the lists """
+        C = train_centroids(vectors, self.num_lists)
+        self.centroids = np.ascontiguousarray(C.T)
+        self.num_lists = len(C)
+        self.offsets = np.zeros(self.num_lists + 1, dtype=np.int64)
+        self.add(vectors, keys)
+        self.merge()
+        return self
+
+    def vector(self, row):
+        n = 0 if self.vectors is None else self.vectors.shape[0]
+        if row < n:
+            return self.vectors[row:row+1]
+        for block in self.delta_vectors:
+            if row < n + block.shape[0]:
+                return block[row-n:row-n+1]
+            n += block.shape[0]
+
+    def candidates(self, q, nprobe=None):
+        """ rows in the nprobe lists closest to vector q """
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        s = np.asarray(q @ self.centroids).ravel()
+        lists = np.argpartition(-s, nprobe - 1)[:nprobe]
+        cands = [self.order[_ranges(self.offsets[lists], self.offsets[lists + 1])]]
+        if len(self.delta_lists):
+            n = 0 if self.vectors is None else self.vectors.shape[0]
+            cands.append(n + np.flatnonzero(np.isin(self.delta_lists, lists)))
+        return np.sort(np.concatenate(cands))
+
+    def similarity(self, rows, q):
+        """ exact cosine similarity of q with the given (sorted) rows """
+        n = 0 if self.vectors is None else self.vectors.shape[0]
+        parts = []
+        main = rows[rows < n]
+        if len(main):
+            parts.append(self.vectors[main] @ q.T)
+        for r in rows[rows >= n]:
+            parts.append(self.vector(r) @ q.T)
+        if not parts:
+            return np.zeros(0)
+        return _dense(_vstack(parts)).astype(np.float64).ravel()
+
+    def query(self, q, k, nprobe=None):
+        """ returns (keys, similarities) of the approximate top k neighbors of vector q """
+        rows = self.candidates(q, nprobe)
+        sims = self.similarity(rows, q)
+        if len(sims) > k:
+            top = np.argpartition(-sims, k - 1)[:k]
+            rows, sims = rows[top], sims[top]
+        order = np.lexsort((rows, -sims))
+        return [self.keys[r] for r in rows[order]], sims[order]
+
+    def query_key(self, key, k, nprobe=None):
+        """ neighbors of a paper in the index, itself included. None if we don't have it """
+        row = self.row.get(key)
+        if row is None:
+            return None
+        return self.query(self.vector(row), k, nprobe)
@@ -0,0 +1,227 @@
+"""
+serves the flask app of serve.py on tornado for --prod without ever blocking
+the io loop on a request:
+
+- the flask app runs on a bounded pool of threads instead of the io loop
+  thread, so a slow search or page render only holds up its own request
+- the pages that are mostly mongodb reads (/discuss, /discussions, /toptwtr)
+  first get their documents with non-blocking queries on the io loop, and
+  the view finds them in the wsgi environ under PREFETCH_KEY. without them
+  (flask dev server, or a failed query) the views query mongodb themselves.
+  routes with a page cache for anonymous visitors are not prefetched for
+  requests without a session cookie, the cache answers most of those
+
+the async queries use pymongo's AsyncMongoClient (pymongo >= 4.10). with an
+older pymongo, or an in-process stand-in such as mongomock, ThreadedDatabase
+gives the same api over blocking calls on a small thread pool of its own.
+"""
+
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from tornado.wsgi import WSGIContainer
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.log import enable_pretty_logging
+
+import metrics
+
+# where the views of serve.py find the prefetched documents
+PREFETCH_KEY = 'asp.prefetch'
+
+# the tweets of /toptwtr?timefilter=...
+TWEETS_TOP = {'day': 'tweets_top1', 'week': 'tweets_top7', 'month': 'tweets_top30'}
+
+
+# async api over blocking collections
+# -----------------------------------------------------------------------------
+
+class ThreadedCursor(object):
+    """ the find().sort().limit().to_list() subset of an async cursor """
+
+    def __init__(self, collection, args, kwargs):
+        self._collection = collection
+        self._args, self._kwargs = args, kwargs
+        self._sort, self._limit = None, 0
+
+    def sort(self, spec):
+        self._sort = spec
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def _fetch(self):
+        cursor = self._collection._sync.find(*self._args, **self._kwargs)
+        if self._sort is not None:
+            cursor = cursor.sort(self._sort)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+        return list(cursor)
+
+    async def to_list(self, length=None):
+        docs = await self._collection._run(self._fetch)
+        return docs if length is None else docs[:length]
+
+
+class ThreadedCollection(object):
+    """ the awaitable collection methods the prefetchers use, run on the executor """
+
+    def __init__(self, sync, executor):
+        self._sync = sync
+        self._executor = executor
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def find(self, *args, **kwargs):
+        return ThreadedCursor(self, args, kwargs)
+
+    async def find_one(self, *args):
+        return await self._run(self._sync.find_one, *args)
+
+    async def count_documents(self, query):
+        return await self._run(self._sync.count_documents, query)
+
+
+class ThreadedDatabase(object):
+    """ database whose collections are ThreadedCollections over the ones of sync """
+
+    def __init__(self, sync, threads=4):
+        self._sync = sync
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='mongo')
+
+    def __getattr__(self, name):
+        return ThreadedCollection(self._sync[name], self._executor)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+def async_database(name='arxiv'):
+    """ the async mongodb database the prefetchers query """
+    if hasattr(pymongo, 'AsyncMongoClient'):
+        return pymongo.AsyncMongoClient()[name]
+    print('pymongo %s has no AsyncMongoClient, prefetching on threads instead' % (pymongo.version, ))
+    return ThreadedDatabase(pymongo.MongoClient()[name])
+
+
+# the prefetchers, they make the same queries as the views in serve.py
+# -----------------------------------------------------------------------------
+
+async def prefetch_discuss(mdb, args, tags):
+    """ the comments of the paper, newest first, and the count of each tag of each comment """
+    pid = args.get('id', '')
+    comms = await mdb.comments.find({'pid': pid}).sort(
+        [('time_posted', pymongo.DESCENDING)]).to_list(None)
+    for c in comms:
+        c['_id'] = str(c['_id'])
+    counts = await asyncio.gather(*[mdb.tags.count_documents({'comment_id': c['_id'], 'tag_name': t})
+                                    for c in comms for t in tags])
+    tag_counts = [list(counts[i * len(tags):(i + 1) * len(tags)]) for i in range(len(comms))]
+    return {'comments': comms, 'tag_counts': tag_counts}
+
+
+async def prefetch_discussions(mdb, args, tags):
+    """ the last 100 comments """
+    comms = await mdb.comments.find().sort(
+        [('time_posted', pymongo.DESCENDING)]).limit(100).to_list(None)
+    return {'comments': comms}
+
+
+async def prefetch_toptwtr(mdb, args, tags):
+    """ the 100 papers with the most tweet votes over the time filter """
+    name = TWEETS_TOP.get(args.get('timefilter', 'day'))
+    if name is None:
+        return None
+    tweets = await mdb[name].find().sort([('vote', pymongo.DESCENDING)]).limit(100).to_list(None)
+    return {'tweets': tweets}
+
+
+PREFETCH = {
+    '/discuss': prefetch_discuss,
+    '/discussions': prefetch_discussions,
+    '/toptwtr': prefetch_toptwtr,
+}
+
+
+# the server
+# -----------------------------------------------------------------------------
+
+class PrefetchContainer(WSGIContainer):
+    """ WSGIContainer that runs the prefetcher of a request (if it has one) before the app """
+
+    def __init__(self, app, mdb, executor, tags=(), page_cached=(), session_cookie='session'):
+        super().__init__(app, executor=executor)
+        self.mdb = mdb
+        self.tags = list(tags)
+        self.page_cached = set(page_cached)
+        self.session_cookie = session_cookie
+
+    def __call__(self, request):
+        IOLoop.current().spawn_callback(self.prefetch_and_handle, request)
+
+    async def prefetch_and_handle(self, request):
+        fetch = PREFETCH.get(request.path) if request.method == 'GET' else None
+        if fetch is not None and request.path in self.page_cached and self.session_cookie not in request.cookies:
+            # an anonymous visitor, the page cache answers without mongodb or the view queries it on a miss
+            fetch = None
+        if fetch is not None:
+            # the mongodb commands of the prefetch count against the request, see metrics.py
+            request.counts = metrics.start_request()
+            args = {k: v[-1].decode('utf-8', 'replace') for k, v in request.query_arguments.items()}
+            try:
+                with metrics.span('prefetch'):
+                    request.prefetch = await fetch(self.mdb, args, self.tags)
+            except Exception as e:
+                # the view queries mongodb itself then
+                print('prefetch of %s failed: %r' % (request.path, e))
+        await self.handle_request(request)
+
+    def environ(self, request):
+        environ = super().environ(request)
+        prefetch = getattr(request, 'prefetch', None)
+        if prefetch is not None:
+            environ[PREFETCH_KEY] = prefetch
+        if hasattr(request, 'counts'):
+            environ[metrics.COUNTS_KEY] = request.counts
+        return environ
+
+
+def serve_tornado(app, port, threads, tags=(), mdb=None, sockets=None, grace=30, page_cached=()):
+    """
+    serves app on port (or on the already bound sockets of prefork.py) running
+    it on threads threads, until SIGTERM or SIGINT. then it stops accepting and
+    gives the requests in flight up to grace seconds to finish. page_cached are
+    the paths whose pages are cached for anonymous visitors
+    """
+    enable_pretty_logging()
+    executor = ThreadPoolExecutor(threads, thread_name_prefix='flask')
+
+    async def main():
+        container = PrefetchContainer(app, mdb if mdb is not None else async_database(), executor, tags,
+                                      page_cached, app.config['SESSION_COOKIE_NAME'])
+        server = HTTPServer(container)
+        if sockets is not None:
+            server.add_sockets(sockets)
+        else:
+            server.listen(port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+        server.stop()
+        # connections accepted right before the stop may not have sent their request yet
+        await asyncio.sleep(1)
+        try:
+            # waits for the requests being served, and closes the idle connections
+            await asyncio.wait_for(server.close_all_connections(), grace)
+        except asyncio.TimeoutError:
+            print('gave up on the requests still running after %ds' % (grace, ))
+
+    asyncio.run(main())
+    executor.shutdown(wait=False)
@@ -0,0 +1,96 @@
+"""
+Benchmarks the IVF index of ann.py against exact search: recall@k of the
+approximate neighbors and query latency, for a grid of list counts and
+probes, so the parameters of make_ann.py can be picked. Runs on the tfidf matrix of
+analyze.py with --tfidf, otherwise on a synthetic topic-clustered corpus.
+
+usage: python bench_ann.py [--tfidf] [--lists 256 1024] [--nprobe 4 16 64]
+"""
+
+import time
+import pickle
+import argparse
+
+import numpy as np
+from scipy import sparse
+
+from ann import IVFIndex
+from utils import Config
+
+
+def make_corpus(n, vocab_size, topics, terms_per_paper, rng):
+    """ l2 normalized sparse tfidf-like rows, each drawn from one of a few zipf topics """
+    ranks = np.arange(1, vocab_size + 1)
+    probs = 1.0 / ranks
+    probs /= probs.sum()
+    perms = [rng.permutation(vocab_size) for _ in range(topics)]
+    topic = rng.integers(0, topics, n)
+    rows = np.repeat(np.arange(n), terms_per_paper)
+    cols = np.concatenate([perms[t][rng.choice(vocab_size, terms_per_paper, p=probs)] for t in topic])
+    X = sparse.csr_matrix((rng.random(len(rows)).astype(np.float32) + 0.5, (rows, cols)),
+                          shape=(n, vocab_size))
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1))).ravel()
+    return sparse.diags(1.0 / norms).dot(X).tocsr().astype(np.float32)
+
+
+def exact_topk(X, q, k):
+    s = (X @ q.T).toarray().ravel()
+    top = np.argpartition(-s, k - 1)[:k]
+    return top[np.argsort(-s[top])]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tfidf', action='store_true', help='use the tfidf matrix of analyze.py')
+    parser.add_argument('--size', type=int, default=100000, help='synthetic corpus size')
+    parser.add_argument('--vocab', type=int, default=20000, help='synthetic vocabulary size')
+    parser.add_argument('--topics', type=int, default=200, help='synthetic topics')
+    parser.add_argument('--lists', type=int, nargs='+', default=[256, 1024], help='list counts to try')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 16, 64], help='lists to probe per query')
+    parser.add_argument('-k', type=int, default=50, help='neighbors to retrieve')
+    parser.add_argument('--queries', type=int, default=200, help='number of query papers')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1337)
+    if args.tfidf:
+        print('loading tfidf matrix', Config.tfidf_path)
+        X = pickle.load(open(Config.tfidf_path, 'rb'))['X'].tocsr().astype(np.float32)
+    else:
+        print('generating %d synthetic papers...' % (args.size, ))
+        X = make_corpus(args.size, args.vocab, args.topics, 30, rng)
+    keys = list(range(X.shape[0]))
+    qrows = rng.choice(X.shape[0], size=min(args.queries, X.shape[0]), replace=False)
+
+    t0 = time.perf_counter()
+    truth = [set(exact_topk(X, X[r], args.k)) for r in qrows]
+    t_exact = 1000 * (time.perf_counter() - t0) / len(qrows)
+    print('exact search: %.2fms per query' % (t_exact, ))
+
+    for num_lists in args.lists:
+        t0 = time.perf_counter()
+        ann = IVFIndex(num_lists).build(X, keys)
+        t_build = time.perf_counter() - t0
+        for nprobe in args.nprobe:
+            recalls, ts, ncand = [], [], []
+            for r, true in zip(qrows, truth):
+                t0 = time.perf_counter()
+                found, _ = ann.query_key(r, args.k, nprobe=nprobe)
+                ts.append(time.perf_counter() - t0)
+                recalls.append(len(true.intersection(found)) / len(true))
+                ncand.append(len(ann.candidates(X[r], nprobe)))
+            ts = 1000 * np.array(ts)
+            print('lists=%-5d nprobe=%-4d build %6.1fs  recall@%d %.3f  candidates %8.0f  '
+                  'p50 %6.2fms  p99 %6.2fms' % (num_lists, nprobe, t_build, args.k, np.mean(recalls),
+                                               np.mean(ncand), np.median(ts), np.percentile(ts, 99)))
+
+    # incremental insertion: the last 10% of the papers go through the delta buffer
+    n0 = int(0.9 * X.shape[0])
+    ann = IVFIndex().build(X[:n0], keys[:n0])
+    ann.add(X[n0:], keys[n0:])
+    recalls = []
+    for r, true in zip(qrows, truth):
+        found, _ = ann.query_key(r, args.k)
+        recalls.append(len(true.intersection(found)) / len(true))
+    print('default parameters with %d papers still in the delta buffer: recall@%d %.3f' %
+          (X.shape[0] - n0, args.k, np.mean(recalls)))
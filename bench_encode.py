@@ -0,0 +1,126 @@
+"""
+Benchmarks serve.encode_json on a page of papers, in a request of an
+anonymous visitor: the serve.py one, that copies the fields make_cache.py
+precomputed into the Paper records of the paper store, against a snapshot
+of the old version that parsed dates, flattened affiliations and cropped
+strings on every request.
+
+usage: python bench_encode.py [--page 200] [--repeat 20]
+"""
+
+import time
+import json
+import random
+import argparse
+
+import numpy as np
+from flask import g, session
+
+import serve
+from paper_store import Paper
+from utils import Config, parse_time, flatten
+
+
+def encode_old(ps, n=10, send_images=False, send_abstracts=True):
+    """
+    a snapshot of serve.encode_json from before the display fields were
+    precomputed, on the db2.p dicts of the papers. its mongodb count of the
+    comments of every paper is replaced by the lookup in the discussion counts
+    the current version makes, so only the per paper encoding differs
+    """
+    libids = set()
+    if g.user:
+        libids = serve.get_library(session['user_id'])
+
+    ret = []
+    for i in range(min(len(ps), n)):
+        p = ps[i]
+        if '_rawid' in p:
+            idvv = '%sv%d' % (p['_rawid'], p['_version'])
+        else:
+            idvv = p['url'].replace('/','').replace(':','')
+        struct = {}
+        struct['title'] = p['title']
+        struct['pid'] = idvv
+        struct['rawpid'] = p.get('_rawid','')
+        if 'authors' in p:
+            struct['authors'] = [a['name'] for a in p['authors']]
+        else:
+            struct['authors'] = p['author']
+        struct['affiliation'] = '; '.join(list(set(flatten(p.get('affiliation', [])))))
+        if 'link' in p:
+            struct['link'] = p['link']
+        else:
+            struct['link'] = p['url']
+        struct['in_library'] = 1 if p.get('_rawid', p.get('url')) in libids else 0
+        if send_abstracts:
+            struct['abstract'] = p.get('summary', '')
+        if send_images:
+            struct['img'] = '/static/thumbs/' + idvv + '.pdf.jpg'
+        struct['conf_full_name'] = p.get('conf_full_name', 'arXiv')
+        if len(struct['conf_full_name']) > 24:
+            struct['conf_full_name_trunc'] = struct['conf_full_name'][:24]+'...'
+        else:
+            struct['conf_full_name_trunc'] = struct['conf_full_name']
+        timestruct = parse_time(p.get('published',Config.default_published_time))
+        struct['published_time'] = '%s/%s/%s' % (
+            timestruct.month, timestruct.day, timestruct.year)
+        cc = p.get('arxiv_comment', '')
+        if len(cc) > 100:
+            cc = cc[:100] + '...'
+        struct['comment'] = cc
+        struct['num_discussion'] = serve.DISCUSSION_COUNTS.get(p.get('_rawid') or p['url'], 0)
+        ret.append(struct)
+    return ret
+
+
+def make_paper(i, rng):
+    """ a synthetic arxiv or dblp style record """
+    words = ['learning', 'neural', 'graph', 'deep', 'robust', 'networks', 'models', 'attention']
+    title = ' '.join(rng.choice(words) for _ in range(8))
+    if i % 2 == 0:
+        return {'_rawid': '2101.%05d' % i, '_version': 2, 'title': title,
+                'authors': [{'name': 'Author %d' % j} for j in range(6)],
+                'link': 'http://arxiv.org/abs/2101.%05dv2' % i, 'summary': title * 20,
+                'published': '2021-01-%02dT18:59:59Z' % (i % 28 + 1),
+                'arxiv_comment': 'Accepted at a conference. ' * 8, 'time_published': i}
+    return {'url': 'https://dblp.org/rec/conf/x/%d' % i, 'title': title,
+            'author': ['Author %d' % j for j in range(6)],
+            'affiliation': [['Univ A', ['Univ B']], 'Univ A', 'Lab C'],
+            'conf_full_name': 'International Conference on Learning Representations',
+            'summary': title * 20, 'published': 'Proceedings-2019', 'time_published': i}
+
+
+def timeit(fn, repeat):
+    ts = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        ts.append(time.perf_counter() - t0)
+    return 1000*np.median(ts)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--page', type=int, default=200, help='papers per page')
+    parser.add_argument('--repeat', type=int, default=20, help='timing repeats')
+    args = parser.parse_args()
+
+    rng = random.Random(1337)
+    dicts = [make_paper(i, rng) for i in range(args.page)]
+    papers = [Paper.from_dict(p) for p in dicts]  # what make_cache.py writes to the paper store
+    # serve.py sets these up in __main__, and times its first request against the snapshot load
+    serve.DISCUSSION_COUNTS = {p.key: i % 3 for i, p in enumerate(papers)}
+    serve.FIRST_REQUEST = False
+
+    with serve.app.test_request_context('/'):
+        g.user = None
+        # the same json goes out to the frontend
+        assert json.dumps(encode_old(dicts, args.page), sort_keys=True) == \
+            json.dumps(serve.encode_json(papers, args.page), sort_keys=True)
+
+        t_old = timeit(lambda: encode_old(dicts, args.page), args.repeat)
+        t_new = timeit(lambda: serve.encode_json(papers, args.page), args.repeat)
+    print('%d papers: per request parsing %.2fms, precomputed %.2fms, speedup %.1fx' %
+          (args.page, t_old, t_new, t_old / t_new))
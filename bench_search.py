@@ -0,0 +1,96 @@
+"""
+Benchmarks /search ranking: the old linear scan over search_dict against
+the inverted index from search_index.py, on synthetic corpora. Also times
+"quoted phrase" queries answered from the bigram postings.
+
+usage: python bench_search.py [--sizes 10000 100000 1000000]
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from search_index import build_search_index, search
+
+
+def make_corpus(n, vocab_size, terms_per_paper, rng):
+    """ synthetic search_dict with a zipf-like term distribution """
+    ranks = np.arange(1, vocab_size + 1)
+    probs = 1.0 / ranks
+    probs /= probs.sum()
+    idf = np.log(vocab_size / ranks) + 1.0
+    words = ['w%d' % i for i in range(vocab_size)]
+    pids = ['p%d' % i for i in range(n)]
+    search_dict = {}
+    bigram_dict = {}
+    for pid in pids:
+        tids = rng.choice(vocab_size, size=terms_per_paper, p=probs)
+        search_dict[pid] = {words[t]: float(idf[t]) for t in tids}
+        # pretend consecutive draws are adjacent words of the abstract
+        bigram_dict[pid] = {words[a] + ' ' + words[b]: float(idf[a] + idf[b])
+                            for a, b in zip(tids[:-1], tids[1:])}
+    tscores = dict(zip(pids, rng.random(n)))
+    return pids, search_dict, bigram_dict, tscores, words
+
+
+def scan_search(pids, search_dict, tscores, qparts):
+    """ the linear scan serve.papers_search used to do """
+    scores = []
+    for pid in pids:
+        score = sum(search_dict[pid].get(q, 0) for q in qparts)
+        if score == 0:
+            continue
+        score += 0.0001*tscores[pid]
+        scores.append((score, pid))
+    scores.sort(reverse=True, key=lambda x: x[0])
+    return [x[1] for x in scores if x[0] > 0]
+
+
+def timeit(fn, repeat):
+    ts = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        ts.append(time.perf_counter() - t0)
+    return 1000*np.median(ts)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000], help='corpus sizes to test')
+    parser.add_argument('--vocab', type=int, default=50000, help='vocabulary size')
+    parser.add_argument('--terms', type=int, default=20, help='distinct terms per paper')
+    parser.add_argument('--num-results', type=int, default=200, help='top k to return')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repeats per query')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1337)
+    for n in args.sizes:
+        print('generating %d synthetic papers...' % (n, ))
+        pids, search_dict, bigram_dict, tscores, words = make_corpus(n, args.vocab, args.terms, rng)
+        t0 = time.perf_counter()
+        index = build_search_index(pids, search_dict, tscores, bigram_dict=bigram_dict)
+        print('  index built in %.1fs' % (time.perf_counter() - t0, ))
+
+        # a frequent term, a mid frequency term, a rare term and a multi term query
+        queries = [[words[0]], [words[50]], [words[5000]], [words[3], words[70], words[900]]]
+        for qparts in queries:
+            expected = scan_search(pids, search_dict, tscores, qparts)[:args.num_results]
+            rows, total = search(index, qparts, args.num_results)
+            assert [pids[i] for i in rows] == expected, 'rankings differ for %s' % (qparts, )
+            t_scan = timeit(lambda: scan_search(pids, search_dict, tscores, qparts), 1 if n > 100000 else args.repeat)
+            t_index = timeit(lambda: search(index, qparts, args.num_results), args.repeat)
+            print('  n=%-8d q=%-22s matches=%-7d scan %9.2fms  index %7.2fms  speedup %6.1fx' %
+                  (n, ' '.join(qparts), total, t_scan, t_index, t_scan / t_index))
+
+        # phrases: a frequent bigram, a rare one, a three word phrase and a phrase plus a term
+        phrase_queries = [([], ['w0 w1']), ([], ['w20 w300']), ([], ['w0 w1 w2']), ([words[7]], ['w0 w1'])]
+        for qparts, phrases in phrase_queries:
+            rows, total = search(index, qparts, args.num_results, phrases=phrases)
+            t_index = timeit(lambda: search(index, qparts, args.num_results, phrases=phrases), args.repeat)
+            q = ' '.join(qparts + ['"%s"' % ph for ph in phrases])
+            print('  n=%-8d q=%-22s matches=%-7d phrase index %7.2fms' % (n, q, total, t_index))
+        del search_dict, bigram_dict, index
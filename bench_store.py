@@ -0,0 +1,124 @@
+"""
+Compares the memory of serving processes that each unpickle db2.p with
+processes that map the paper store of paper_store.py: every worker loads the
+papers and reads all of them once, and then reports its unique (USS) and
+proportional (PSS) memory while all workers are still alive. the workers are
+started with spawn, so they share nothing but what they load, and as many
+idle workers give the baseline of the interpreter and the imports. the store
+workers also report the PSS of the papers.store mapping itself. Also reports
+the load time and the time to look up a paper, and the bytes per paper of
+the full db2.p dicts against the compact Paper records, in memory and pickled.
+
+usage: python bench_store.py [--workers 4]
+"""
+
+import os
+import time
+import pickle
+import random
+import argparse
+import tracemalloc
+import multiprocessing as mp
+
+from paper_store import PaperStore, Paper
+from snapshot import snapshot_dir
+from utils import Config, process_memory
+
+
+def mapping_pss(path):
+    """ PSS in MB of the mappings of path in this process, from /proc/self/smaps """
+    pss, inside = 0, False
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            parts = line.split()
+            if '-' in parts[0] and not parts[0].endswith(':'):
+                # the header line of a mapping, its path (if it has one) comes last
+                inside = parts[-1] == path
+            elif inside and parts[0] == 'Pss:':
+                pss += int(parts[1])
+    return pss / 1024
+
+
+def worker(mode, barrier, results):
+    t_load = t_get = 0.0
+    path = os.path.realpath(os.path.join(snapshot_dir(), 'papers.store'))
+    if mode != 'idle':
+        t0 = time.perf_counter()
+        if mode == 'pickle':
+            db = pickle.load(open(Config.db_serve_path, 'rb'))
+        else:
+            db = PaperStore(path)
+        t_load = time.perf_counter() - t0
+        keys = list(db)
+        for k in keys:
+            db[k]
+        sample = random.Random(1337).sample(keys, min(len(keys), 10000))
+        t0 = time.perf_counter()
+        for k in sample:
+            db[k]
+        t_get = 1e6 * (time.perf_counter() - t0) / len(sample)
+    # measure while all the workers hold their papers, so shared pages are split between them
+    barrier.wait()
+    uss, pss = process_memory()
+    results.put((uss, pss, mapping_pss(path), t_load, t_get))
+    barrier.wait()
+
+
+def resident_bytes(blob):
+    """ bytes allocated by unpickling blob """
+    tracemalloc.start()
+    obj = pickle.loads(blob)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return size
+
+
+def record_sizes():
+    """ bytes per paper of the db2.p dicts and of the Paper records, resident and pickled one by one """
+    db = pickle.load(open(Config.db_serve_path, 'rb'))
+    papers = {k: Paper.from_dict(p) for k, p in db.items()}
+    n = len(db)
+    for name, d in (('dict', db), ('Paper', papers)):
+        # the whole mapping pickled at once, so strings shared between papers stay shared
+        resident = resident_bytes(pickle.dumps(d, -1)) / n
+        stored = sum(len(pickle.dumps(p, -1)) for p in d.values()) / n
+        sample = random.Random(1337).sample(list(d), min(n, 10000))
+        blobs = [pickle.dumps(d[k], -1) for k in sample]
+        t0 = time.perf_counter()
+        for b in blobs:
+            pickle.loads(b)
+        t_load = 1e6 * (time.perf_counter() - t0) / len(blobs)
+        print('%-6s resident %6.0f bytes/paper  pickled %6.0f bytes/paper  unpickle %5.1fus' %
+              (name, resident, stored, t_load))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=4, help='number of processes')
+    args = parser.parse_args()
+
+    # not fork, a forked worker would start out sharing the pages of this process
+    ctx = mp.get_context('spawn')
+    base = None
+    for mode in ('idle', 'pickle', 'store'):
+        barrier = ctx.Barrier(args.workers)
+        results = ctx.Queue()
+        procs = [ctx.Process(target=worker, args=(mode, barrier, results)) for _ in range(args.workers)]
+        for p in procs:
+            p.start()
+        rs = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        uss, pss, store_pss, t_load, t_get = [sum(x) / len(rs) for x in zip(*rs)]
+        if base is None:
+            base = (uss, pss)
+            print('%-6s x%d  per worker: USS %7.1fMB  PSS %7.1fMB' % (mode, args.workers, uss, pss))
+            continue
+        print('%-6s x%d  per worker over idle: USS %7.1fMB  PSS %7.1fMB (papers.store mapping %6.1fMB)'
+              '  load %6.3fs  lookup %5.1fus   total PSS %7.1fMB' %
+              (mode, args.workers, uss - base[0], pss - base[1], store_pss, t_load, t_get,
+               (pss - base[1]) * args.workers))
+
+    record_sizes()
@@ -2,14 +2,23 @@
 import os
 import sys
 import pickle
+import argparse
 # non-standard imports
 import numpy as np
 from sklearn import svm
 from sqlite3 import dbapi2 as sqlite3
 # local imports
-from utils import safe_pickle_dump, strip_version, Config
+from utils import safe_pickle_dump, strip_version, Config, load_lsa, lsa_dense
+from snapshot import republish_snapshot
 
 num_recommendations = 1000 # papers to recommend per user
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--lsa', dest='lsa', action='store_true',
+                    help='train on the LSA embeddings of make_lsa.py instead of the dense tfidf matrix')
+parser.add_argument('--int8', dest='int8', action='store_true',
+                    help='with --lsa, read the int8 quantized embeddings')
+args = parser.parse_args()
 # -----------------------------------------------------------------------------
 
 if not os.path.isfile(Config.database_path):
@@ -31,13 +40,21 @@ def query_db(query, args=(), one=False):
 users = query_db('''select * from user''')
 print('number of users: ', len(users))
 
-# load the tfidf matrix and meta
-meta = pickle.load(open(Config.meta_path, 'rb'))
-out = pickle.load(open(Config.tfidf_path, 'rb'))
-X = out['X']
-X = X.todense().astype(np.float32)
+if args.lsa:
+  # a few hundred floats per paper instead of the densified tfidf matrix
+  E, meta = load_lsa(args.int8)
+  X = lsa_dense(E, meta)
+  xtoi = meta['ptoi']
+  xkeys = meta['keys']
+else:
+  # load the tfidf matrix and meta
+  meta = pickle.load(open(Config.meta_path, 'rb'))
+  out = pickle.load(open(Config.tfidf_path, 'rb'))
+  X = out['X']
+  X = X.todense().astype(np.float32)
 
-xtoi = { strip_version(x):i for x,i in meta['ptoi'].items() }
+  xtoi = { strip_version(x):i for x,i in meta['ptoi'].items() }
+  xkeys = [strip_version(x) for x in meta['pids']]
 
 user_sim = {}
 for ii,u in enumerate(users):
@@ -60,7 +77,11 @@ for ii,u in enumerate(users):
 
   sortix = np.argsort(-s)
   sortix = sortix[:min(num_recommendations, len(sortix))] # crop paper recommendations to save space
-  user_sim[uid] = [strip_version(meta['pids'][ix]) for ix in list(sortix)]
+  user_sim[uid] = [xkeys[ix] for ix in list(sortix)]
 
 print('writing', Config.user_sim_path)
 safe_pickle_dump(user_sim, Config.user_sim_path)
+# a server running on the snapshot of the last make_cache.py reloads the new recommendations
+version = republish_snapshot(['user_sim'])
+if version is not None:
+  print('published snapshot', version, 'to', Config.snapshot_path)
@@ -0,0 +1,100 @@
+"""
+Load test for a running serve.py: a number of concurrent clients request
+pages for a while, optionally logged in and while others toggle papers in
+their library (the writes that used to block sqlite readers), and the
+throughput and latency percentiles are reported per kind of request.
+
+usage: python load_test.py --url http://localhost:5000 [--concurrency 16] [--duration 10]
+           [--username foo --password bar] [--writers 2]
+"""
+
+import time
+import random
+import argparse
+import threading
+
+import numpy as np
+import requests
+
+
+def client(base, paths, until, results, session, lock):
+    lat, errors = [], 0
+    while time.time() < until:
+        t0 = time.perf_counter()
+        try:
+            r = session.get(base + random.choice(paths), timeout=30)
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        lat.append(time.perf_counter() - t0)
+        errors += not ok
+    with lock:
+        results['read'][0].extend(lat)
+        results['read'][1] += errors
+
+
+def writer(base, pids, until, results, session, lock):
+    lat, errors = [], 0
+    while time.time() < until:
+        t0 = time.perf_counter()
+        try:
+            r = session.post(base + '/libtoggle', data={'pid': random.choice(pids)}, timeout=30)
+            ok = r.status_code == 200 and r.text in ('ON', 'OFF')
+        except requests.RequestException:
+            ok = False
+        lat.append(time.perf_counter() - t0)
+        errors += not ok
+    with lock:
+        results['write'][0].extend(lat)
+        results['write'][1] += errors
+
+
+def login(base, username, password):
+    s = requests.Session()
+    s.post(base + '/login', data={'username': username, 'password': password})
+    return s
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:5000', help='where serve.py runs')
+    parser.add_argument('--paths', nargs='+', default=['/', '/top?timefilter=alltime', '/search?q=learning',
+                                                      '/library', '/recommend'], help='pages to request')
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help='concurrent reading clients')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds to run')
+    parser.add_argument('--username', help='log the clients in as this user')
+    parser.add_argument('--password', help='password of --username')
+    parser.add_argument('-w', '--writers', type=int, default=0,
+                        help='clients toggling library papers at the same time (needs --username)')
+    args = parser.parse_args()
+
+    base = args.url.rstrip('/')
+    # some pids to toggle, from the first page
+    pids = []
+    if args.writers:
+        r = requests.get(base + '/api/v1/recent')
+        pids = [p['pid'] for p in r.json()['papers']]
+
+    results = {'read': [[], 0], 'write': [[], 0]}
+    lock = threading.Lock()
+    until = time.time() + args.duration
+    threads = []
+    for i in range(args.concurrency):
+        s = login(base, args.username, args.password) if args.username else requests.Session()
+        threads.append(threading.Thread(target=client, args=(base, args.paths, until, results, s, lock)))
+    for i in range(args.writers):
+        s = login(base, args.username, args.password)
+        threads.append(threading.Thread(target=writer, args=(base, pids, until, results, s, lock)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for kind, (lat, errors) in results.items():
+        if not lat:
+            continue
+        lat = 1000 * np.array(lat)
+        print('%-5s %7d requests %8.1f req/s  errors %-5d p50 %7.1fms  p90 %7.1fms  p99 %7.1fms  max %7.1fms' % (
+            kind, len(lat), len(lat) / args.duration, errors, np.median(lat), np.percentile(lat, 90),
+            np.percentile(lat, 99), lat.max()))
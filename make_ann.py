@@ -0,0 +1,78 @@
+"""
+Builds (or updates) the approximate nearest neighbor index of ann.py over
+the tfidf vectors written by analyze.py, or with --lsa over the LSA
+embeddings of make_lsa.py. serve.py uses it with --ann.
+
+With --update, papers that are not in the index yet are inserted into the
+existing one instead of rebuilding it. This is only valid while the vectors
+live in the same space, i.e. the tfidf vocabulary or the LSA embedding did
+not change; when it did the index is rebuilt from scratch.
+"""
+
+import os
+import pickle
+import hashlib
+import argparse
+
+from ann import IVFIndex
+from utils import Config, safe_pickle_dump, strip_version, load_lsa, lsa_dense
+
+
+def vocab_fingerprint(vocab):
+    """ identifies the feature space of the vectors """
+    h = hashlib.md5()
+    for t, i in sorted(vocab.items(), key=lambda x: x[1]):
+        h.update(t.encode('utf-8') + b'\n')
+    return h.hexdigest()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--lists', dest='lists', type=int,
+                        default=1024, help='number of k-means lists to split the papers into')
+    parser.add_argument('-n', '--nprobe', dest='nprobe', type=int,
+                        default=16, help='default number of lists a query looks into')
+    parser.add_argument('--lsa', dest='lsa', action='store_true',
+                        help='index the LSA embeddings of make_lsa.py instead of the tfidf vectors')
+    parser.add_argument('--int8', dest='int8', action='store_true',
+                        help='with --lsa, read the int8 quantized embeddings')
+    parser.add_argument('-u', '--update', dest='update', action='store_true',
+                        help='insert new papers into the existing index instead of rebuilding it')
+    args = parser.parse_args()
+    print(args)
+
+    if args.lsa:
+        print('loading LSA embeddings', Config.lsa_int8_path if args.int8 else Config.lsa_path)
+        E, meta = load_lsa(args.int8)
+        X = lsa_dense(E, meta)
+        keys = meta['keys']
+        space = 'lsa-' + meta['version']
+    else:
+        print('loading tfidf_meta', Config.meta_path)
+        meta = pickle.load(open(Config.meta_path, 'rb'))
+        print('loading tfidf matrix', Config.tfidf_path)
+        X = pickle.load(open(Config.tfidf_path, 'rb'))['X'].tocsr()
+        keys = meta.get('keys') or [strip_version(p) for p in meta['pids']]
+        space = vocab_fingerprint(meta['vocab'])
+
+    ann = None
+    if args.update and os.path.isfile(Config.ann_path):
+        ann = pickle.load(open(Config.ann_path, 'rb'))
+        if getattr(ann, 'space', None) != space:
+            print('the vectors changed space since the index was built, rebuilding it')
+            ann = None
+
+    if ann is None:
+        print('indexing %d papers in %d lists...' % (len(keys), args.lists))
+        ann = IVFIndex(args.lists, args.nprobe).build(X, keys)
+        ann.space = space
+    else:
+        # new papers go to the closest existing centroid
+        ann.nprobe = args.nprobe
+        n = ann.add(X, keys)
+        ann.merge()
+        print('inserted %d new papers, %d in the index' % (n, len(ann)))
+
+    print('writing', Config.ann_path)
+    safe_pickle_dump(ann, Config.ann_path)
@@ -3,7 +3,7 @@ computes various cache things on top of db.py so that the server
 (running from serve.py) can start up and serve faster when restarted.
 
 this script should be run whenever db.p is updated, and 
-creates db2.p, which can be read by the server.
+creates db2.p and a new snapshot (see snapshot.py), which the server reads.
 """
 
 import os
@@ -14,9 +14,13 @@ import numpy as np
 import sys
 from tqdm import tqdm
 from datetime import datetime
+from urllib.parse import urlparse
 
 from sqlite3 import dbapi2 as sqlite3
-from utils import safe_pickle_dump, Config, load_db, parse_time, flatten
+from utils import safe_pickle_dump, Config, load_db, parse_time, flatten, paper_display
+from snapshot import write_snapshot
+from search_index import build_search_index, build_prefix_index, tfidf_tokenize, tfidf_bigrams, \
+    index_words, completion_query, parse_query, match
 
 sqldb = sqlite3.connect(Config.database_path)
 sqldb.row_factory = sqlite3.Row  # to return dicts rather than tuples
@@ -55,6 +59,8 @@ for pid, p in tqdm(db.items()):
     timestruct = parse_time(p.get('published',Config.default_published_time))
     if timestruct.year < 2010:
         pid_to_remove.append(pid)
+    # what the frontend shows of the paper, so the server doesn't redo it on every request
+    p['_display'] = paper_display(p, timestruct)
     if timestruct.replace(tzinfo=None) > datetime.now().replace(tzinfo=None): # this means the time is wrongly parsed
         timestruct = parse_time(Config.default_published_time)
     # store in struct for future convenience
@@ -77,6 +83,9 @@ print('precomputing papers date sorted...')
 scores = [(p['time_published'], pid) for pid, p in db.items()]
 scores.sort(reverse=True, key=lambda x: x[0])
 CACHE['date_sorted_pids'] = [sp[1] for sp in scores] # newest at start
+# the search index uses the same order, remember where every paper is in it
+for i, pid in enumerate(CACHE['date_sorted_pids']):
+    db[pid]['_row'] = i
 
 # compute top papers in peoples' libraries
 print('computing top papers...')
@@ -90,15 +99,12 @@ top_paper_counts = sorted([(v, k)
 CACHE['top_sorted_pids'] = [q[1] for q in top_paper_counts]
 
 # some utilities for creating a search index for faster search
-# removed hyphen from string.punctuation
-punc = "'!\"#$%&\'()*+,./:;<=>?@[\\]^_`{|}~'"
-trans_table = {ord(c): None for c in punc}
 
 
 def makedict(s, forceidf=None, scale=1.0):
-    words = set(s.lower().translate(trans_table).strip().split())
+    words = set(index_words(s))
     idfd = {}
-    for w in words:  # todo: if we're using bigrams in vocab then this won't search over them
+    for w in words:  # bigrams are indexed separately, see makebigrams
         if forceidf is None:
             if w in vocab:
                 # we have idf for this
@@ -111,6 +117,15 @@ def makedict(s, forceidf=None, scale=1.0):
     return idfd
 
 
+def makebigrams(s, forceidf=None):
+    # only bigrams of the tfidf vocab, tokenized the same way analyze.py does
+    idfd = {}
+    for b in tfidf_bigrams(tfidf_tokenize(s)):
+        if b in vocab:
+            idfd[b] = idf[vocab[b]] if forceidf is None else forceidf
+    return idfd
+
+
 def merge_dicts(dlist):
     m = {}
     for d in dlist:
@@ -122,22 +137,84 @@ def merge_dicts(dlist):
 
 print('building an index for faster search...')
 search_dict = {}
+bigram_dict = {}
+fuzzy_terms = set()  # misspelled queries get corrected to title words and author names
 for pid, p in tqdm(db.items()):
     dict_title = makedict(p['title'], forceidf=5, scale=3)
-    dict_authors = makedict(' '.join(x['name']
-                            for x in p.get('authors','')), forceidf=5)
+    # the other sites give plain author names, autocomplete offers those too
+    names = [x['name'] for x in p['authors']] if 'authors' in p else p.get('author', [])
+    dict_authors = makedict(' '.join(names), forceidf=5)
 
     dict_affiliation = makedict(''.join(flatten(p.get('affiliation',[]))), forceidf=5)
     if 'and' in dict_authors:
         # special case for "and" handling in authors list
         del dict_authors['and']
     dict_summary = makedict(p.get('summary', ''))
+    fuzzy_terms.update(dict_title)
+    fuzzy_terms.update(dict_authors)
     search_dict[pid] = merge_dicts(
         [dict_title, dict_authors, dict_affiliation, dict_summary])
-CACHE['search_dict'] = search_dict
+    bigram_dict[pid] = merge_dicts(
+        [makebigrams(p['title'], forceidf=5), makebigrams(p.get('summary', ''))])
+
+def paper_source(p):
+    # arXiv, or the site we scraped the paper from (dl.acm.org, ieeexplore.ieee.org, ...)
+    if '_rawid' in p:
+        return 'arXiv'
+    host = urlparse(p.get('url', '')).netloc
+    return host[4:] if host.startswith('www.') else (host or 'other')
+
+print('inverting the search index...')
+# rows of the index follow the date sorted order, newest first
+CACHE['search_index'] = build_search_index(
+    CACHE['date_sorted_pids'], search_dict, {pid: p['tscore'] for pid, p in db.items()},
+    bigram_dict=bigram_dict, venues={pid: p.get('conf_full_name', 'arXiv') for pid, p in db.items()},
+    fuzzy_terms=fuzzy_terms, facets={
+        'venue': {pid: p.get('conf_full_name', 'arXiv') for pid, p in db.items()},
+        'year': {pid: datetime.fromtimestamp(p['time_published']).year for pid, p in db.items()},
+        'source': {pid: paper_source(p) for pid, p in db.items()},
+    })
+del search_dict, bigram_dict, fuzzy_terms
+
+print('building the autocomplete index...')
+# popularity of a title is how many libraries it is in (recent papers first on ties),
+# authors and venues are ranked by their number of papers plus library counts
+title_pop = {}
+author_pop = {}
+venue_pop = {}
+for pid, p in db.items():
+    title = ' '.join(p['title'].split())
+    popularity = counts.get(pid, 0)
+    title_pop[title] = max(title_pop.get(title, 0), popularity + p['tscore'])
+    names = [x['name'] for x in p['authors']] if 'authors' in p else p.get('author', [])
+    for name in names:
+        name = ' '.join(name.split())
+        author_pop[name] = author_pop.get(name, 0) + 1 + popularity
+    venue = p.get('conf_full_name', 'arXiv')
+    venue_pop[venue] = venue_pop.get(venue, 0) + 1 + popularity
+entries = [(t, 'title', v) for t, v in title_pop.items()]
+entries += [(a, 'author', v) for a, v in author_pop.items()]
+entries += [(c, 'venue', v) for c, v in venue_pop.items()]
+CACHE['prefix_index'] = build_prefix_index(entries)
+del entries, title_pop, author_pop, venue_pop
+
+# every completion is searched as a quoted phrase when it is picked, so it has
+# to find the paper it came from. check that on the newest papers
+missed = []
+for row, pid in enumerate(CACHE['date_sorted_pids'][:200]):
+    p = db[pid]
+    names = [x['name'] for x in p['authors']] if 'authors' in p else p.get('author', [])
+    texts = [p['title']] + names + [p.get('conf_full_name', 'arXiv')]
+    for text in texts:
+        qparts, phrases = parse_query(completion_query(' '.join(text.split())))
+        rows, _ = match(CACHE['search_index'], qparts, phrases)
+        if row not in rows:
+            missed.append((pid, text))
+if missed:
+    print('WARNING: %d completions don\'t find their paper, e.g. %s' % (len(missed), missed[:5]))
 
-# save the cache
-print('writing', Config.serve_cache_path)
-safe_pickle_dump(CACHE, Config.serve_cache_path)
 print('writing', Config.db_serve_path)
 safe_pickle_dump(db, Config.db_serve_path)
+# what serve.py reads, it replaces serve_cache.p
+version = write_snapshot(db, CACHE, meta)
+print('published snapshot', version, 'to', Config.snapshot_path)
@@ -0,0 +1,96 @@
+"""
+Computes a compact LSA embedding of every paper: a truncated SVD of the tfidf
+matrix written by analyze.py, l2 normalized, so dot products are cosine
+similarities. Saves it as a raw float32 .npy that consumers memory map
+(see utils.load_lsa), optionally also int8 quantized with a scale per row,
+plus lsa_meta.p with the db key of every row.
+
+make_sim.py, make_ann.py and buildsvm.py can use it with --lsa instead of
+unpickling the whole sparse tfidf matrix.
+"""
+
+import os
+import time
+import pickle
+import argparse
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from sklearn.decomposition import TruncatedSVD
+
+from utils import Config, safe_pickle_dump, strip_version
+
+# max number of documents to fit the svd on (chosen randomly), for memory efficiency
+max_train = 100000
+
+
+def write_npy(path, shape, dtype, fill):
+    """ fills a new .npy file block by block next to path, then moves it into place """
+    tmp = path + '.tmp.npy'
+    E = open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+    fill(E)
+    E.flush()
+    del E
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--dims', dest='dims', type=int,
+                        default=256, help='dimensions of the embedding')
+    parser.add_argument('--int8', dest='int8', action='store_true',
+                        help='also write an int8 quantized copy (4x smaller)')
+    parser.add_argument('-b', '--block-size', dest='block_size', type=int,
+                        default=10000, help='rows to transform at a time')
+    args = parser.parse_args()
+    print(args)
+
+    print('loading tfidf_meta', Config.meta_path)
+    meta = pickle.load(open(Config.meta_path, 'rb'))
+    print('loading tfidf matrix', Config.tfidf_path)
+    X = pickle.load(open(Config.tfidf_path, 'rb'))['X'].tocsr()
+    keys = meta.get('keys') or [strip_version(p) for p in meta['pids']]
+    N = X.shape[0]
+    dims = min(args.dims, X.shape[1] - 1)
+
+    rng = np.random.default_rng(1337)
+    train = np.sort(rng.choice(N, size=min(N, max_train), replace=False))
+    print('fitting a %d dimensional truncated svd on %d documents...' % (dims, len(train)))
+    t0 = time.time()
+    svd = TruncatedSVD(n_components=dims, algorithm='randomized', n_iter=5, random_state=1337)
+    svd.fit(X[train])
+    print('done in %.1fs, explained variance %.3f' % (time.time() - t0, svd.explained_variance_ratio_.sum()))
+
+    scale = np.zeros(N, dtype=np.float32)
+
+    def fill(E):
+        for i in range(0, N, args.block_size):
+            Z = svd.transform(X[i:i + args.block_size]).astype(np.float32)
+            Z /= np.maximum(np.linalg.norm(Z, axis=1, keepdims=True), 1e-12)
+            E[i:i + len(Z)] = Z
+            # symmetric int8 quantization, one scale per row
+            scale[i:i + len(Z)] = np.abs(Z).max(axis=1) / 127.0
+            print('%d/%d...' % (min(N, i + args.block_size), N))
+
+    print('writing', Config.lsa_path)
+    write_npy(Config.lsa_path, (N, dims), np.float32, fill)
+
+    if args.int8:
+        E = np.load(Config.lsa_path, mmap_mode='r')
+
+        def fill_int8(Q):
+            for i in range(0, N, args.block_size):
+                s = np.maximum(scale[i:i + args.block_size, None], 1e-12)
+                Q[i:i + len(s)] = np.round(E[i:i + len(s)] / s).astype(np.int8)
+
+        print('writing', Config.lsa_int8_path)
+        write_npy(Config.lsa_int8_path, (N, dims), np.int8, fill_int8)
+
+    out = {}
+    out['keys'] = keys  # db key of every row
+    out['ptoi'] = {k: i for i, k in enumerate(keys)}
+    out['scale'] = scale  # int8 row i is E[i] / scale[i]
+    out['version'] = '%d-%d' % (int(time.time()), dims)  # identifies the embedding space
+    print('writing', Config.lsa_meta_path)
+    safe_pickle_dump(out, Config.lsa_meta_path)
@@ -0,0 +1,125 @@
+"""
+Precomputes the most similar papers of every paper (the "similar papers"
+shown on a paper's page) from the tfidf matrix written by analyze.py.
+
+The similarities are computed on the sparse matrix, one block of rows at a
+time and on all cores, keeping only the top k of every row. Writes sim.npz
+with the neighbors of every row of X as int32 row indices (-1 padded) and
+their cosine similarities as float16, plus the db key of every row.
+
+With --lsa the dense LSA embeddings of make_lsa.py are used instead, which
+is much cheaper on large corpora.
+"""
+
+import time
+import pickle
+import argparse
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from scipy import sparse
+
+from utils import Config, open_atomic, strip_version, load_lsa, lsa_dense
+from snapshot import republish_snapshot
+
+# set before the workers are forked, so they share them instead of getting copies
+X = None
+XT = None
+
+
+def topk_block_dense(span):
+    """ topk_block for dense embeddings """
+    i0, i1, k = span
+    S = X[i0:i1] @ XT  # dense BxN
+    rows = np.arange(i1 - i0)
+    S[rows, i0 + rows] = np.inf  # the paper itself goes first
+    top = np.argpartition(-S, k - 1, axis=1)[:, :k]
+    vals = np.take_along_axis(S, top, axis=1)
+    order = np.argsort(-vals, axis=1, kind='stable')
+    idx = np.take_along_axis(top, order, axis=1).astype(np.int32)
+    sims = np.take_along_axis(vals, order, axis=1).astype(np.float16)
+    sims[:, 0] = 1.0
+    return i0, idx, sims
+
+
+def topk_block(span):
+    """ the k most similar rows of every row in [i0, i1), the row itself first """
+    i0, i1, k = span
+    if not sparse.issparse(X):
+        return topk_block_dense(span)
+    S = (X[i0:i1] @ XT).tocsr()  # sparse BxN, only the papers sharing a term
+    idx = np.full((i1 - i0, k), -1, dtype=np.int32)
+    sims = np.zeros((i1 - i0, k), dtype=np.float16)
+    for j in range(i1 - i0):
+        a, b = S.indptr[j], S.indptr[j+1]
+        cols, vals = S.indices[a:b], S.data[a:b]
+        # the paper itself goes first, even if an identical duplicate ties with it
+        other = cols != i0 + j
+        cols, vals = cols[other], vals[other]
+        if len(vals) > k - 1:
+            top = np.argpartition(-vals, k - 2)[:k - 1]
+            cols, vals = cols[top], vals[top]
+        order = np.argsort(-vals, kind='stable')
+        n = len(order)
+        idx[j, 0] = i0 + j
+        sims[j, 0] = 1.0
+        idx[j, 1:n+1] = cols[order]
+        sims[j, 1:n+1] = vals[order]
+    return i0, idx, sims
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--num-neighbors', dest='k', type=int,
+                        default=50, help='similar papers to keep per paper, including itself')
+    parser.add_argument('-b', '--block-size', dest='block_size', type=int,
+                        default=None, help='rows of X to multiply at a time per worker (default 256, 32 with --lsa)')
+    parser.add_argument('--lsa', dest='lsa', action='store_true',
+                        help='use the LSA embeddings of make_lsa.py instead of the tfidf vectors')
+    parser.add_argument('--int8', dest='int8', action='store_true',
+                        help='with --lsa, read the int8 quantized embeddings')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+    print(args)
+
+    if args.lsa:
+        print('loading LSA embeddings', Config.lsa_int8_path if args.int8 else Config.lsa_path)
+        E, meta = load_lsa(args.int8)
+        # a float32 memory map is shared by the workers as is, int8 gets dequantized once
+        X = E if E.dtype == np.float32 else lsa_dense(E, meta)
+        XT = X.T
+        keys = meta['keys']
+    else:
+        print('loading tfidf_meta', Config.meta_path)
+        meta = pickle.load(open(Config.meta_path, 'rb'))
+        print('loading tfidf matrix', Config.tfidf_path)
+        X = pickle.load(open(Config.tfidf_path, 'rb'))['X'].tocsr().astype(np.float32)
+        XT = X.T.tocsr()
+        # older tfidf_meta.p files don't have the db keys, recover them from the pids
+        keys = meta.get('keys') or [strip_version(p) for p in meta['pids']]
+    N = X.shape[0]
+    block_size = args.block_size or (32 if args.lsa else 256)
+
+    k = min(args.k, N)
+    idx = np.zeros((N, k), dtype=np.int32)
+    sims = np.zeros((N, k), dtype=np.float16)
+    spans = [(i, min(N, i + block_size), k) for i in range(0, N, block_size)]
+    print('computing the %d nearest neighbors of %d papers in %d blocks...' % (k, N, len(spans)))
+    t0 = time.time()
+    with Pool(args.workers) as pool:
+        for done, (i0, bidx, bsims) in enumerate(pool.imap_unordered(topk_block, spans), 1):
+            idx[i0:i0 + len(bidx)] = bidx
+            sims[i0:i0 + len(bsims)] = bsims
+            if done % 100 == 0:
+                print('%d/%d blocks, %.1fs...' % (done, len(spans), time.time() - t0))
+    print('done in %.1fs' % (time.time() - t0, ))
+
+    print('writing', Config.sim_path)
+    with open_atomic(Config.sim_path, 'wb') as f:
+        np.savez(f, idx=idx, sims=sims, keys=np.array(keys))
+    # a server running on the snapshot of the last make_cache.py reloads the new similar papers
+    version = republish_snapshot(['sim'])
+    if version is not None:
+        print('published snapshot', version, 'to', Config.snapshot_path)
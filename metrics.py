@@ -0,0 +1,203 @@
+"""
+lightweight metrics of serve.py, shown in the prometheus text format on
+/metrics: latency histograms per route and per named span of the hot paths
+(search, encoding, sqlite, mongodb, rendering), and counts of the sqlite
+statements and mongodb commands of every request.
+
+recording is a bisect and two adds under a lock, and nothing runs in the
+background, so an idle server pays nothing. every process keeps its own
+numbers, with --workers each scrape answers for the worker that takes it
+(see the worker label).
+"""
+
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+from functools import wraps
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+# upper bounds of the buckets, in seconds
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# and of the number of statements/commands a request makes
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# labels added to every series, e.g. the worker number of prefork.py
+CONST_LABELS = {}
+
+REGISTRY = []
+
+
+def _format_labels(names, values):
+    pairs = list(CONST_LABELS.items()) + list(zip(names, values))
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"')) for k, v in pairs)
+
+
+def _format_bound(b):
+    return '+Inf' if b == float('inf') else repr(float(b))
+
+
+class Counter(object):
+    """ counts per combination of label values """
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def expose(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % (self.name, )]
+        for labels, v in values:
+            lines.append('%s%s %s' % (self.name, _format_labels(self.labels, labels), v))
+        return lines
+
+
+class Histogram(object):
+    """ observations per combination of label values, counted in fixed buckets """
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'), )
+        self._series = {}  # label values -> [count of every bucket..., sum]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * len(self.buckets) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def expose(self):
+        with self._lock:
+            series = sorted((labels, list(s)) for labels, s in self._series.items())
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % (self.name, )]
+        names = self.labels + ('le', )
+        for labels, s in series:
+            total = 0
+            for b, n in zip(self.buckets, s):
+                total += n
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(names, labels + (_format_bound(b), )), total))
+            lines.append('%s_sum%s %r' % (self.name, _format_labels(self.labels, labels), s[-1]))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(self.labels, labels), total))
+        return lines
+
+
+def expose():
+    """ all the metrics in the prometheus text format """
+    lines = []
+    for m in REGISTRY:
+        lines.extend(m.expose())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram('asp_request_seconds', 'time to answer a request, by route',
+                            ('route', 'method', 'status'))
+SPAN_SECONDS = Histogram('asp_span_seconds', 'time spent in the hot paths of serve.py', ('span', ))
+MONGO_SECONDS = Histogram('asp_mongo_command_seconds', 'duration of mongodb commands', ('command', ))
+MONGO_FAILURES = Counter('asp_mongo_command_failures_total', 'mongodb commands that failed', ('command', ))
+REQUEST_SQLITE = Histogram('asp_request_sqlite_statements', 'sqlite statements per request, by route',
+                           ('route', ), COUNT_BUCKETS)
+REQUEST_MONGO = Histogram('asp_request_mongo_commands', 'mongodb round trips per request, by route',
+                          ('route', ), COUNT_BUCKETS)
+
+
+# spans
+# -----------------------------------------------------------------------------
+
+@contextmanager
+def span(name):
+    """ records the time spent in the with block as span name """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - t0, name)
+
+
+def timed(name):
+    """ decorator recording the time spent in the function as span name """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                SPAN_SECONDS.observe(time.perf_counter() - t0, name)
+        return wrapped
+    return decorator
+
+
+# what a request does
+# -----------------------------------------------------------------------------
+
+# where serve.py finds the counts a prefetch of async_serve.py started
+COUNTS_KEY = 'asp.counts'
+
+# the counts of the request being served. a contextvar, so they follow the
+# request into the asyncio task of its prefetch as well as its thread
+_counts = contextvars.ContextVar('asp_counts', default=None)
+
+
+class RequestCounts(object):
+    """ the sqlite statements and mongodb commands of one request """
+    __slots__ = ('sqlite', 'mongo')
+
+    def __init__(self):
+        self.sqlite = 0
+        self.mongo = 0
+
+
+def start_request(counts=None):
+    """ counts what happens from here on in this thread or task, in counts or new ones """
+    counts = counts if counts is not None else RequestCounts()
+    _counts.set(counts)
+    return counts
+
+
+def count_sqlite(statement):
+    """ the trace callback of the sqlite connections """
+    counts = _counts.get()
+    if counts is not None:
+        counts.sqlite += 1
+
+
+class MongoListener(monitoring.CommandListener):
+    """ times every mongodb command, and counts it against the request that made it """
+
+    def started(self, event):
+        counts = _counts.get()
+        if counts is not None:
+            counts.mongo += 1
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+        MONGO_FAILURES.inc(event.command_name)
+
+
+def finish_request(route, method, status, seconds):
+    """ records a request that took seconds, and what it did """
+    REQUEST_SECONDS.observe(seconds, route, method, status)
+    counts = _counts.get()
+    if counts is not None:
+        REQUEST_SQLITE.observe(counts.sqlite, route)
+        REQUEST_MONGO.observe(counts.mongo, route)
+        _counts.set(None)
@@ -0,0 +1,202 @@
+"""
+read-only on-disk store of the papers, used by serve.py instead of unpickling
+all of db2.p into every worker process.
+
+the store is one file that is memory mapped: every paper is pickled, as a
+compact Paper record of just the fields the server uses, into a record heap,
+a sorted array of 64 bit hashes of the db keys finds the row of a key, and
+numeric fields the server filters whole lists of papers on are also kept as
+columns. all workers map the same file, so its pages are shared through the
+page cache instead of being copied into each process, and opening it is
+instant. the papers themselves are only unpickled when a request shows them.
+
+written by snapshot.write_snapshot() (run by make_cache.py) with
+write_paper_store(), into a new snapshot directory every time, so a process
+keeps reading the version it mapped.
+"""
+
+import sys
+import json
+import mmap
+import pickle
+from bisect import bisect_left
+from hashlib import blake2b
+from collections import namedtuple
+
+import numpy as np
+
+from utils import open_atomic, paper_display
+
+MAGIC = b'ASPSTORE'
+VERSION = 2
+ALIGN = 64
+# numeric fields kept as columns as well, see PaperStore.field_values
+COLUMNS = {'time_published': np.int64, '_row': np.int64}
+
+
+# what the frontend shows of a paper, in the order of utils.paper_display
+DISPLAY_FIELDS = ('title', 'pid', 'rawpid', 'authors', 'affiliation', 'link', 'abstract',
+                  'conf_full_name', 'conf_full_name_trunc', 'published_time', 'comment')
+
+
+class Paper(namedtuple('Paper', ('rawid', 'version', 'url', 'updated', 'time_published') + DISPLAY_FIELDS)):
+    """
+    the serve side record of a paper: only the fields serve.py reads, in a
+    tuple instead of the dict of dicts of feedparser. the rest of an entry
+    (links, tags, categories, author dicts...) stays in db2.p
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, p):
+        """ the record of a paper of db2.p. authors and venues repeat a lot, so they are interned """
+        d = p.get('_display') or paper_display(p)
+        d = dict(d, authors=tuple(sys.intern(a) for a in d['authors']),
+                 conf_full_name=sys.intern(d['conf_full_name']),
+                 conf_full_name_trunc=sys.intern(d['conf_full_name_trunc']))
+        return cls(p.get('_rawid', ''), p.get('_version', 0), p.get('url', ''), p.get('updated', ''),
+                   p['time_published'], *[d[f] for f in DISPLAY_FIELDS])
+
+    @property
+    def key(self):
+        """ the db key of the paper, also what comments are stored under """
+        return self.rawid or self.url
+
+    def display(self):
+        """ a new dict of the shown fields, for serve.encode_json to add the dynamic ones to """
+        return dict(zip(DISPLAY_FIELDS, self[5:]))
+
+
+def key_hash(key):
+    """ stable across processes, unlike hash() """
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _heap(blobs):
+    """ concatenation of the byte strings, and the offsets of each (n + 1 of them) """
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in blobs], out=offsets[1:])
+    return np.frombuffer(b''.join(blobs), dtype=np.uint8), offsets
+
+
+def write_paper_store(db, path, order=None):
+    """ writes the papers of db (key -> dict, as in db2.p) to path, in the row order of the keys in order """
+    keys = list(db) if order is None else list(order)
+    arrays = {}
+    arrays['keys'], arrays['key_offsets'] = _heap([k.encode('utf-8') for k in keys])
+    arrays['records'], arrays['record_offsets'] = _heap([pickle.dumps(Paper.from_dict(db[k]), -1) for k in keys])
+    hashes = np.array([key_hash(k) for k in keys], dtype=np.uint64)
+    by_hash = np.argsort(hashes, kind='stable')
+    arrays['hashes'] = hashes[by_hash]
+    arrays['hash_rows'] = by_hash.astype(np.int64)
+    for name, dtype in COLUMNS.items():
+        arrays['col_' + name] = np.array([db[k].get(name, -1) for k in keys], dtype=dtype)
+
+    # the header lists where every array starts, the arrays follow aligned
+    layout, offset = {}, 0
+    for name, a in arrays.items():
+        layout[name] = [a.dtype.str, offset, len(a)]
+        offset += -(-a.nbytes // ALIGN) * ALIGN
+    header = json.dumps({'version': VERSION, 'n': len(keys), 'arrays': layout}).encode('utf-8')
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    with open_atomic(path, 'wb') as f:
+        f.write(MAGIC + len(header).to_bytes(8, 'little') + header)
+        for name, a in arrays.items():
+            f.seek(start + layout[name][1])
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+
+
+class PaperStore(object):
+    """
+    read-only mapping of db key -> Paper over a file of write_paper_store.
+    store[key] unpickles the paper, so hold on to it rather than looking it up
+    again. rows(keys) and field_values(name, keys) answer for whole lists at once
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a paper store' % (path, ))
+        n = int.from_bytes(self._mm[len(MAGIC):len(MAGIC) + 8], 'little')
+        header = json.loads(self._mm[len(MAGIC) + 8:len(MAGIC) + 8 + n].decode('utf-8'))
+        if header['version'] != VERSION:
+            raise ValueError('%s has version %d, expected %d, run make_cache.py again' %
+                             (path, header['version'], VERSION))
+        start = -(-(len(MAGIC) + 8 + n) // ALIGN) * ALIGN
+        self._n = header['n']
+        self._a = {name: np.frombuffer(self._mm, dtype=dtype, count=count, offset=start + offset)
+                   for name, (dtype, offset, count) in header['arrays'].items()}
+        # where the heaps start in the file, slicing the mmap directly is the cheapest read
+        self._keys_at = start + header['arrays']['keys'][1]
+        self._records_at = start + header['arrays']['records'][1]
+        # the same memory as python sequences, single lookups are much cheaper on these than on numpy
+        self._hashes = memoryview(self._a['hashes']).cast('B').cast('Q')
+        self._hash_rows = memoryview(self._a['hash_rows']).cast('B').cast('q')
+        self._key_offsets = memoryview(self._a['key_offsets']).cast('B').cast('q')
+        self._record_offsets = memoryview(self._a['record_offsets']).cast('B').cast('q')
+
+    def __len__(self):
+        return self._n
+
+    def key(self, row):
+        a, b = self._key_offsets[row], self._key_offsets[row + 1]
+        return self._mm[self._keys_at + a:self._keys_at + b].decode('utf-8')
+
+    def _find(self, key, h, p):
+        # almost always one candidate, more only on a hash collision
+        while p < self._n and self._hashes[p] == h:
+            r = self._hash_rows[p]
+            if self.key(r) == key:
+                return r
+            p += 1
+        return -1
+
+    def row(self, key):
+        """ row of key, or -1 if we don't have it """
+        h = key_hash(key)
+        return self._find(key, h, bisect_left(self._hashes, h))
+
+    def rows(self, keys):
+        """ rows of all the keys, -1 for the ones we don't have """
+        h = [key_hash(k) for k in keys]
+        pos = np.searchsorted(self._a['hashes'], np.array(h, dtype=np.uint64)).tolist()
+        return np.array([self._find(k, hk, p) for k, hk, p in zip(keys, h, pos)], dtype=np.int64)
+
+    def record(self, row):
+        a, b = self._record_offsets[row], self._record_offsets[row + 1]
+        return pickle.loads(self._mm[self._records_at + a:self._records_at + b])
+
+    def column(self, name):
+        """ the field name (one of COLUMNS) of all the papers, by row """
+        return self._a['col_' + name]
+
+    def field_values(self, name, keys):
+        """ the field name (one of COLUMNS) of all the keys, which must all be in the store """
+        rows = self.rows(keys)
+        if len(rows) and rows.min() < 0:
+            raise KeyError(keys[int(np.argmin(rows))])
+        return self.column(name)[rows]
+
+    def __contains__(self, key):
+        return self.row(key) >= 0
+
+    def __getitem__(self, key):
+        r = self.row(key)
+        if r < 0:
+            raise KeyError(key)
+        return self.record(r)
+
+    def get(self, key, default=None):
+        r = self.row(key)
+        return default if r < 0 else self.record(r)
+
+    def __iter__(self):
+        return (self.key(r) for r in range(self._n))
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((self.key(r), self.record(r)) for r in range(self._n))
@@ -0,0 +1,150 @@
+"""
+pre-fork serving for serve.py --prod --workers N. the master process loads
+the snapshot once, moves everything allocated so far out of the reach of the
+garbage collector (gc.freeze, so collections in the workers don't write to
+those objects and un-share their pages) and forks the workers, which all
+accept on the same listening socket. the master then only looks after them:
+
+- a worker that dies is replaced
+- SIGHUP is passed on to the workers, they reload the data files
+- SIGUSR2 restarts the workers one at a time: a new one is forked, then the
+  old one gets SIGTERM, stops accepting and finishes its requests
+- SIGTERM or SIGINT stops all the workers the same way, then the master
+- SIGUSR1 prints the memory of every worker, see memory_report
+"""
+
+import os
+import gc
+import sys
+import time
+import signal
+import multiprocessing as mp
+
+from utils import process_memory
+
+
+class Generations(object):
+    """
+    counters in memory shared with all the workers, one per slot. a worker
+    that changes something every worker caches (a library, the discussion
+    counts) bumps its counter, and the others see that their copy is stale
+    """
+
+    def __init__(self, n=1):
+        self._a = mp.Array('q', n)
+        self._n = n
+
+    def get(self, key=0):
+        return self._a[key % self._n]
+
+    def bump(self, key=0):
+        """ increments the counter of key and returns the new value """
+        with self._a.get_lock():
+            i = key % self._n
+            self._a[i] += 1
+            return self._a[i]
+
+
+def memory_report(workers):
+    """ prints the unique (USS) and proportional (PSS) memory of the master and every worker """
+    rows = [('master', os.getpid())] + [('worker %d' % i, pid) for pid, i in sorted(workers.items(), key=lambda x: x[1])]
+    total_uss = total_pss = 0
+    for name, pid in rows:
+        m = process_memory(pid)
+        if m is None:
+            print('%-10s pid %-7d memory not available' % (name, pid))
+            continue
+        total_uss += m[0]
+        total_pss += m[1]
+        print('%-10s pid %-7d USS %8.1fMB  PSS %8.1fMB' % (name, pid, m[0], m[1]))
+    print('%-18s USS %8.1fMB  PSS %8.1fMB' % ('total', total_uss, total_pss))
+
+
+def prefork(n, grace=30):
+    """
+    forks n workers and returns in each of them with its number (0..n-1).
+    the master stays in here looking after them until it is stopped, and then
+    exits. grace is how many seconds stopping workers get before they are killed
+    """
+    gc.collect()
+    gc.freeze()
+    signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2)
+    handlers = {sig: signal.getsignal(sig) for sig in signals}
+    pending = []  # signals received, handled in the loop below
+    for sig in signals:
+        signal.signal(sig, lambda signum, frame: pending.append(signum))
+
+    workers = {}  # pid -> worker number
+    started = {}  # pid -> time it was forked
+
+    def spawn(i):
+        pid = os.fork()
+        if pid == 0:
+            # the worker: serve.py's own signal handlers again
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+            return True
+        workers[pid] = i
+        started[pid] = time.time()
+        return False
+
+    for i in range(n):
+        if spawn(i):
+            return i
+    print('master %d forked %d workers: %s' % (os.getpid(), n, ' '.join(str(pid) for pid in workers)))
+
+    restart = []  # (number, pid) of the workers still to restart, one at a time
+    retiring = set()  # pids sent SIGTERM to make way for a new worker
+    stop_time = None
+    while True:
+        while pending:
+            sig = pending.pop(0)
+            if sig == signal.SIGHUP:
+                print('master: reloading the workers')
+                for pid in workers:
+                    os.kill(pid, signal.SIGHUP)
+            elif sig == signal.SIGUSR1:
+                memory_report(workers)
+            elif sig == signal.SIGUSR2:
+                print('master: restarting the workers one by one')
+                restart = sorted((i, pid) for pid, i in workers.items())
+            elif stop_time is None:
+                print('master: stopping the workers')
+                stop_time = time.time()
+                for pid in workers:
+                    os.kill(pid, signal.SIGTERM)
+
+        # the workers that exited
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            i = workers.pop(pid, None)
+            if i is None:
+                continue
+            if pid in retiring:
+                retiring.discard(pid)
+            elif stop_time is None:
+                print('worker %d (pid %d) exited with status %d, starting a new one' % (i, pid, status))
+                if time.time() - started[pid] < 1:
+                    time.sleep(1)  # don't spin on a worker that can't start
+                if spawn(i):
+                    return i
+            del started[pid]
+
+        if stop_time is not None:
+            if not workers:
+                print('master: all workers stopped')
+                sys.exit(0)
+            if time.time() - stop_time > grace:
+                for pid in workers:
+                    os.kill(pid, signal.SIGKILL)
+        elif restart and not retiring:
+            # the next one, once the last one we retired has finished
+            i, pid = restart.pop(0)
+            if pid in workers:
+                if spawn(i):
+                    return i
+                retiring.add(pid)
+                os.kill(pid, signal.SIGTERM)
+        time.sleep(0.1)
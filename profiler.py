@@ -0,0 +1,109 @@
+"""
+on demand sampling profiler of single requests of serve.py, for the pages
+that are slow in production but not locally. a request carrying the key of
+profile_key.txt in an X-Profile header (or a _profile query argument) gets a
+thread that samples the stack of the thread serving it, and when it is done
+the samples are written to Config.profile_dir as a speedscope file (open it
+on https://www.speedscope.app), together with the route, arguments and
+timings. other requests only pay for looking at the header.
+
+the sampler needs the gil to take a sample, so next to a request busy in
+python it only gets to run every switch interval (sys.getswitchinterval(),
+5ms by default) instead of every INTERVAL. every sample is weighted by the
+time it stands for, so the profile still adds up to the wall time, just in
+coarser steps. the switch interval is left alone because it is process
+wide, and would slow down the other requests too.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import itertools
+import threading
+
+# seconds between samples
+INTERVAL = 0.002
+
+# numbers the profiles this process writes, so two in the same millisecond don't share a file
+_saved = itertools.count()
+
+
+class Sampler(threading.Thread):
+    """ samples the stack of the thread thread_id until stop(), weighting each sample by the time it stands for """
+
+    def __init__(self, thread_id, interval=INTERVAL):
+        super().__init__(name='profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}  # (name, file, line) of every frame, outermost first -> seconds
+        self.samples = 0
+        self._done = threading.Event()
+        self.start_time = time.perf_counter()
+        self.start()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, frame.f_lineno))
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            now = time.perf_counter()
+            self.stacks[stack] = self.stacks.get(stack, 0) + now - last
+            self.samples += 1
+            last = now
+
+    def stop(self):
+        """ stops sampling, and returns the wall time since the start in seconds """
+        wall = time.perf_counter() - self.start_time
+        self._done.set()
+        self.join()
+        return wall
+
+
+def speedscope(name, stacks, meta):
+    """ the stacks of a Sampler as a speedscope document of one sampled profile, meta is kept along """
+    frames, index = [], {}
+    samples, weights = [], []
+    for stack, seconds in stacks.items():
+        ids = []
+        for f in stack:
+            if f not in index:
+                index[f] = len(frames)
+                frames.append({'name': f[0], 'file': f[1], 'line': f[2]})
+            ids.append(index[f])
+        samples.append(ids)
+        weights.append(seconds * 1000)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'arxiv-sanity serve.py',
+        'activeProfileIndex': 0,
+        'shared': {'frames': frames},
+        'profiles': [{'type': 'sampled', 'name': name, 'unit': 'milliseconds',
+                      'startValue': 0, 'endValue': sum(weights), 'samples': samples, 'weights': weights}],
+        'meta': meta,
+    }
+
+
+def save(sampler, dirpath, route, meta):
+    """ stops sampler and writes its profile with meta to dirpath, returns the file name """
+    wall = sampler.stop()
+    meta = dict(meta, route=route, wall_ms=wall * 1000, samples=sampler.samples,
+                interval_ms=sampler.interval * 1000, pid=os.getpid(), time=time.time())
+    name = '%s %s %.0fms' % (meta.get('method', ''), meta.get('path', route), wall * 1000)
+    now = time.time()
+    fname = '%s.%03d-%d-%d-%s.speedscope.json' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+                                                 int(now * 1000) % 1000, os.getpid(), next(_saved),
+                                                 re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root')
+    os.makedirs(dirpath, exist_ok=True)
+    with open(os.path.join(dirpath, fname), 'w') as f:
+        json.dump(speedscope(name, sampler.stacks, meta), f)
+    return fname
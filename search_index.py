@@ -0,0 +1,555 @@
+"""
+inverted index used by serve.py to answer /search queries.
+
+make_cache.py builds the index once from the per-paper term weights and
+serve.py only ever touches the postings of the query terms, so the cost
+of a query scales with the number of matching papers instead of the size
+of the whole corpus.
+"""
+
+import re
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, strip_accents_unicode
+
+# must match the TfidfVectorizer settings in analyze.py, so that the
+# bigrams we produce here are the ones that ended up in meta['vocab']
+TOKEN_PATTERN = re.compile(r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b')
+PHRASE_PATTERN = re.compile(r'"([^"]*)"')
+# removed from the words of the word postings, all of string.punctuation but the hyphen
+PUNCTUATION = "'!\"#$%&\'()*+,./:;<=>?@[\\]^_`{|}~'"
+PUNCT_TABLE = {ord(c): None for c in PUNCTUATION}
+# completion keys are cropped to this many characters
+MAX_KEY_LEN = 64
+# completions for prefixes up to this length are precomputed
+TOP_PREFIX_LEN = 3
+# queries with fewer hits than this also search similarly spelled terms
+FUZZY_MIN_HITS = 5
+
+
+def tfidf_tokenize(s):
+    """ same tokens as the tfidf analyzer: accents stripped, lowercased, no stop words """
+    tokens = TOKEN_PATTERN.findall(strip_accents_unicode(s.lower()))
+    return [t for t in tokens if t not in ENGLISH_STOP_WORDS]
+
+
+def tfidf_bigrams(tokens):
+    return [tokens[i] + ' ' + tokens[i+1] for i in range(len(tokens) - 1)]
+
+
+def index_words(s):
+    """ the words of the word postings: lowercased, punctuation removed, accents kept """
+    return s.lower().translate(PUNCT_TABLE).split()
+
+
+def normalize_key(s):
+    """ lowercased, accents stripped, whitespace collapsed. used for names and prefixes """
+    return ' '.join(strip_accents_unicode(s.lower()).replace('"', ' ').split())
+
+
+def parse_query(qraw):
+    """
+    splits a raw query into free terms and "quoted phrases".
+    an unbalanced quote is ignored.
+    """
+    q = qraw.lower().strip()
+    phrases = [' '.join(ph.split()) for ph in PHRASE_PATTERN.findall(q) if ph.strip()]
+    terms = PHRASE_PATTERN.sub(' ', q).replace('"', ' ').split()
+    return terms, phrases
+
+
+def normalize_query(qraw):
+    """
+    canonical form of a query, for caching. term order does not change the
+    ranking, so terms and phrases are sorted (repeated terms are kept, they count twice).
+    """
+    terms, phrases = parse_query(qraw)
+    return ' '.join(sorted(terms) + sorted('"%s"' % (ph, ) for ph in phrases))
+
+
+def build_postings(rows):
+    """
+    builds a compact term -> postings structure.
+    rows is a sequence of {term: weight} dicts, one per paper, in row order.
+    postings of every term are stored back to back in two flat arrays
+    (row index as int32, weight as float32), sorted by row index within a term.
+    """
+    terms = {}
+    term_ids = array('i')
+    row_ids = array('i')
+    weights = array('f')
+    for i, d in enumerate(rows):
+        for t, w in d.items():
+            tid = terms.get(t)
+            if tid is None:
+                tid = len(terms)
+                terms[t] = tid
+            term_ids.append(tid)
+            row_ids.append(i)
+            weights.append(w)
+
+    term_ids = np.frombuffer(term_ids, dtype=np.int32)
+    # stable sort keeps the rows of every term in increasing order
+    order = np.argsort(term_ids, kind='stable')
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=len(terms)), out=offsets[1:])
+    return {
+        'terms': terms,
+        'offsets': offsets,
+        'idx': np.frombuffer(row_ids, dtype=np.int32)[order],
+        'w': np.frombuffer(weights, dtype=np.float32)[order],
+    }
+
+
+def get_postings(postings, term):
+    """ returns (rows, weights) of a term, or None if we never saw it """
+    tid = postings['terms'].get(term)
+    if tid is None:
+        return None
+    a, b = postings['offsets'][tid], postings['offsets'][tid+1]
+    return postings['idx'][a:b], postings['w'][a:b]
+
+
+def build_search_index(pids, search_dict, tscores, bigram_dict=None, venues=None, fuzzy_terms=None,
+                       facets=None):
+    """
+    pids gives the row order of the index, search_dict maps pid -> {term: weight}
+    and tscores maps pid -> recency score in [0,1]. bigram_dict optionally maps
+    pid -> {bigram: weight} and is used to answer quoted phrases. venues
+    optionally maps pid -> venue name, so a quoted venue name finds its papers.
+    fuzzy_terms is an optional set of terms (e.g. from titles and author names)
+    that misspelled query terms can be corrected to. facets optionally maps a
+    facet name to {pid: value}, see build_facets.
+    """
+    index = {
+        'pids': list(pids),
+        'tscore': np.array([tscores[pid] for pid in pids], dtype=np.float64),
+        'words': build_postings(search_dict[pid] for pid in pids),
+    }
+    if bigram_dict is not None:
+        index['bigrams'] = build_postings(bigram_dict[pid] for pid in pids)
+    if venues is not None:
+        index['venues'] = build_postings({normalize_key(venues[pid]): 5.0} for pid in pids)
+    if fuzzy_terms is not None:
+        index['trigrams'] = build_trigrams(sorted(fuzzy_terms))
+    if facets is not None:
+        index['facets'] = build_facets(index['pids'], facets)
+    return index
+
+
+def merge_postings(lists):
+    """
+    merges a list of (rows, weights) postings into unique rows with summed weights.
+    weights are summed in float64 so the tiny recency boost still breaks ties.
+    """
+    if not lists:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+    if len(lists) == 1:
+        return lists[0][0], lists[0][1].astype(np.float64)
+    rows = np.concatenate([r for r, _ in lists])
+    weights = np.concatenate([w for _, w in lists]).astype(np.float64)
+    order = np.argsort(rows, kind='stable')
+    rows = rows[order]
+    weights = weights[order]
+    # start of every run of equal rows
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    return rows[starts], np.add.reduceat(weights, starts)
+
+
+def intersect_postings(lists):
+    """ like merge_postings, but only keeps the rows present in all the lists """
+    if len(lists) == 1:
+        return merge_postings(lists)
+    rows, weights = merge_postings(lists)
+    counts = np.zeros(len(rows), dtype=np.int32)
+    for r, _ in lists:
+        counts[np.searchsorted(rows, r)] += 1
+    keep = counts == len(lists)
+    return rows[keep], weights[keep]
+
+
+def phrase_postings(index, phrase):
+    """
+    rows containing the phrase, with the summed weights of its parts.
+    a phrase of two or more tfidf tokens is answered from the bigram postings.
+    when some of its bigrams were never indexed (e.g. author names, rare
+    bigrams outside the tfidf vocabulary) we fall back to requiring all its words.
+    a phrase that is exactly a venue name returns the papers of that venue.
+    """
+    if 'venues' in index:
+        pl = get_postings(index['venues'], normalize_key(phrase))
+        if pl is not None:
+            return merge_postings([pl])
+    bigrams = tfidf_bigrams(tfidf_tokenize(phrase))
+    lists = None
+    if bigrams and 'bigrams' in index:
+        lists = [get_postings(index['bigrams'], b) for b in bigrams]
+        if any(pl is None for pl in lists):
+            lists = None
+    if lists is None:
+        lists = [get_postings(index['words'], w) for w in index_words(phrase)]
+    if not lists or any(pl is None for pl in lists):
+        return merge_postings([])
+    return intersect_postings(lists)
+
+
+def top_k(rows, scores, k):
+    """
+    returns the k highest scoring rows in descending score order. ties go to
+    the lower (newer) row, so the ranking does not depend on k and pages line up.
+    """
+    if k < len(scores):
+        # everything strictly above the k-th score, then fill up with its ties
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = scores > kth
+        ties = np.flatnonzero(scores == kth)[:k - np.count_nonzero(above)]
+        keep = np.flatnonzero(above)
+        keep = np.concatenate([keep, ties])
+        rows, scores = rows[keep], scores[keep]
+    order = np.lexsort((rows, -scores))
+    return rows[order]
+
+
+def match(index, qparts, phrases=()):
+    """
+    scores every paper that contains at least one of the query terms, the same
+    way the old linear scan over search_dict did (sum of term weights, plus a
+    small boost for recent papers), and returns (rows, scores) of all matches.
+    if phrases are given, only papers containing all of them are returned and
+    the query terms just add to their score.
+    """
+    lists = []
+    for q in qparts:
+        pl = get_postings(index['words'], q)
+        if pl is not None:
+            lists.append(pl)
+    rows, scores = merge_postings(lists)
+    if phrases:
+        prows, pscores = intersect_postings([phrase_postings(index, ph) for ph in phrases])
+        # add in the score of the free terms for the phrase matches that have them
+        ix = np.minimum(np.searchsorted(rows, prows), max(len(rows) - 1, 0))
+        hit = rows[ix] == prows if len(rows) else np.zeros(len(prows), dtype=bool)
+        pscores[hit] += scores[ix[hit]]
+        rows, scores = prows, pscores
+    # the weights are all positive, so every merged row is a match
+    return rows, scores + 0.0001*index['tscore'][rows]
+
+
+def search(index, qparts, k, phrases=()):
+    """ like match, but returns (top k rows, number of matches) """
+    rows, scores = match(index, qparts, phrases)
+    return top_k(rows, scores, k), len(rows)
+
+
+# tfidf ranking
+# -----------------------------------------------------------------------------
+
+def tfidf_matrix(X, xkeys, pids):
+    """
+    the tfidf matrix of analyze.py with its rows moved into index row order.
+    xkeys are the db keys of the rows of X. papers without a tfidf vector get
+    an empty row. stored column major, so a query only touches the columns of
+    its own terms.
+    """
+    row = {pid: i for i, pid in enumerate(pids)}
+    to_row = np.array([row.get(key, -1) for key in xkeys], dtype=np.int64)
+    X = X.tocoo()
+    rows = to_row[X.row]
+    keep = rows >= 0
+    return sparse.csc_matrix((X.data[keep].astype(np.float32), (rows[keep], X.col[keep])),
+                             shape=(len(pids), X.shape[1]))
+
+
+def tfidf_query(qparts, phrases, vocab, idf):
+    """
+    the query as a tfidf vector, weighted like the TfidfVectorizer of
+    analyze.py does it (sublinear tf, idf, l2 norm). returns (columns, values).
+    free terms are unordered once normalized, so only phrases give bigrams.
+    """
+    tokens = tfidf_tokenize(' '.join(qparts))
+    for ph in phrases:
+        pt = tfidf_tokenize(ph)
+        tokens += pt + tfidf_bigrams(pt)
+    tf = {}
+    for t in tokens:
+        if t in vocab:
+            tf[vocab[t]] = tf.get(vocab[t], 0) + 1
+    cols = np.array(sorted(tf), dtype=np.int64)
+    vals = np.array([(1.0 + np.log(tf[c])) * idf[c] for c in cols], dtype=np.float64)
+    if len(vals):
+        vals /= np.linalg.norm(vals)
+    return cols, vals
+
+
+def tfidf_match(index, X, vocab, idf, qparts, phrases=()):
+    """
+    like match, but scores are the cosine similarity of the tfidf vectors of
+    the query and the paper. X is the tfidf_matrix of the index.
+    """
+    cols, vals = tfidf_query(qparts, phrases, vocab, idf)
+    if not len(cols):
+        rows, scores = np.zeros(0, dtype=np.int64), np.zeros(0)
+    else:
+        scores = X[:, cols] @ vals
+        rows = np.flatnonzero(scores)
+        scores = scores[rows]
+    if phrases:
+        # quoted phrases must still appear in the paper
+        prows, _ = intersect_postings([phrase_postings(index, ph) for ph in phrases])
+        keep = np.isin(rows, prows, assume_unique=True)
+        rows, scores = rows[keep], scores[keep]
+    return rows, scores
+
+
+# facets
+# -----------------------------------------------------------------------------
+
+def build_facets(pids, columns):
+    """
+    columns maps a facet name to {pid: value}. every facet is dictionary
+    encoded: a sorted list of its distinct values and an int32 array with the
+    code of the value of every row, so filtering and counting a candidate set
+    is a couple of vectorized lookups instead of a pass over the papers.
+    the counts over the whole corpus are precomputed.
+    """
+    facets = {}
+    for name, col in columns.items():
+        values = sorted(set(col.values()))
+        code = {v: i for i, v in enumerate(values)}
+        codes = np.array([code[col[pid]] for pid in pids], dtype=np.int32)
+        facets[name] = {
+            'values': values,
+            'codes': codes,
+            'counts': np.bincount(codes, minlength=len(values)),
+        }
+    return facets
+
+
+def facet_allowed(facets, filters):
+    """
+    filters maps a facet name to a list of accepted values, or to a (lo, hi)
+    range for numeric facets like the year. returns per facet a boolean array
+    telling which of its values pass.
+    """
+    allowed = {}
+    for name, accept in filters.items():
+        if name not in facets:
+            continue
+        values = facets[name]['values']
+        if isinstance(accept, tuple):
+            lo, hi = accept
+            allowed[name] = np.array([lo <= v <= hi for v in values], dtype=bool)
+        else:
+            accept = set(accept)
+            allowed[name] = np.array([v in accept for v in values], dtype=bool)
+    return allowed
+
+
+def filter_facets(index, rows, filters, top=20):
+    """
+    rows are the candidate rows, or None for the whole corpus. returns
+    (mask of the candidates passing all filters, or None if nothing was
+    filtered, and the facet counts). the counts of a facet are taken over the
+    candidates passing all the other filters, so they show what choosing
+    another value of that facet would give. counts are lists of
+    (value, count), most frequent first, except for years that stay in order.
+    """
+    facets = index.get('facets', {})
+    allowed = facet_allowed(facets, filters)
+    cols = {name: f['codes'] if rows is None else f['codes'][rows] for name, f in facets.items()}
+    masks = {name: ok[cols[name]] for name, ok in allowed.items()}
+
+    def combine(names):
+        m = None
+        for name in names:
+            m = masks[name] if m is None else m & masks[name]
+        return m
+
+    counts = {}
+    for name, facet in facets.items():
+        others = combine(n for n in masks if n != name)
+        nv = len(facet['values'])
+        if others is None:
+            c = facet['counts'] if rows is None else np.bincount(cols[name], minlength=nv)
+        else:
+            c = np.bincount(cols[name][others], minlength=nv)
+        nz = np.flatnonzero(c)
+        if name != 'year':
+            nz = nz[np.argsort(-c[nz], kind='stable')][:top]
+        counts[name] = [(facet['values'][i], int(c[i])) for i in nz]
+    return combine(masks), counts
+
+
+# typo tolerance
+# -----------------------------------------------------------------------------
+
+def trigrams(term):
+    """ character trigrams of a term, padded so that its start and end count too """
+    t = '$' + term + '$'
+    return {t[i:i+3] for i in range(len(t) - 2)}
+
+
+def build_trigrams(terms):
+    """ trigram -> sorted int32 array of the ids of the terms that contain it """
+    grams = {}
+    gram_ids = array('i')
+    term_ids = array('i')
+    for i, t in enumerate(terms):
+        for gr in trigrams(t):
+            gid = grams.get(gr)
+            if gid is None:
+                gid = len(grams)
+                grams[gr] = gid
+            gram_ids.append(gid)
+            term_ids.append(i)
+    gram_ids = np.frombuffer(gram_ids, dtype=np.int32)
+    order = np.argsort(gram_ids, kind='stable')
+    offsets = np.zeros(len(grams) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(gram_ids, minlength=len(grams)), out=offsets[1:])
+    return {
+        'terms': terms,
+        'grams': grams,
+        'offsets': offsets,
+        'idx': np.frombuffer(term_ids, dtype=np.int32)[order],
+    }
+
+
+def edit_distance(a, b):
+    """
+    levenshtein distance where swapping two neighbouring characters also
+    counts as one edit. only ever run on a handful of candidates.
+    """
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            d = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j-2] and a[i-2] == cb:
+                d = min(d, prev2[j-2] + 1)
+            cur.append(d)
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+def similar_terms(tri, term, k=2, candidates=50):
+    """
+    up to k indexed terms spelled like term, ranked by the number of shared
+    trigrams and then by edit distance. at most 1 edit is allowed for short
+    terms and 2 for longer ones.
+    """
+    lists = []
+    for gr in trigrams(term):
+        gid = tri['grams'].get(gr)
+        if gid is not None:
+            lists.append(tri['idx'][tri['offsets'][gid]:tri['offsets'][gid+1]])
+    if not lists:
+        return []
+    ids, overlap = np.unique(np.concatenate(lists), return_counts=True)
+    if candidates < len(ids):
+        part = np.argpartition(-overlap, candidates)[:candidates]
+        ids, overlap = ids[part], overlap[part]
+    max_dist = 1 if len(term) <= 5 else 2
+    scored = []
+    for i, o in zip(ids, overlap):
+        t = tri['terms'][i]
+        if t == term or abs(len(t) - len(term)) > max_dist:
+            continue
+        d = edit_distance(term, t)
+        if d <= max_dist:
+            scored.append((-o, d, t))
+    scored.sort()
+    return [t for _, _, t in scored[:k]]
+
+
+def correct_terms(index, qparts, min_hits=FUZZY_MIN_HITS):
+    """
+    for every query term that (almost) never occurs, the similarly spelled
+    terms to search for as well. returns {term: [corrections]}.
+    """
+    if 'trigrams' not in index:
+        return {}
+    out = {}
+    for q in qparts:
+        if len(q) < 4 or not q.isalpha():
+            continue  # too short to say anything about its spelling
+        pl = get_postings(index['words'], q)
+        if pl is not None and len(pl[0]) >= min_hits:
+            continue
+        similar = similar_terms(index['trigrams'], q)
+        if similar:
+            out[q] = similar
+    return out
+
+
+# prefix index for autocompletion
+# -----------------------------------------------------------------------------
+
+def build_prefix_index(entries, top_size=20):
+    """
+    entries is a list of (text, kind, popularity) tuples. every entry is
+    reachable from the prefixes of its normalized text, authors also from the
+    start of any of their name parts (so "lecun" finds "Yann LeCun").
+    keys are kept in one sorted list that is searched with bisect, and the
+    most popular completions of very short prefixes are precomputed because
+    their key ranges span a large part of the list.
+    """
+    keyed = []
+    for eid, (text, kind, _) in enumerate(entries):
+        words = normalize_key(text).split(' ')
+        starts = range(len(words)) if kind == 'author' else [0]
+        for s in starts:
+            key = ' '.join(words[s:])[:MAX_KEY_LEN]
+            if key:
+                keyed.append((key, eid))
+    keyed.sort()
+    index = {
+        'keys': [k for k, _ in keyed],
+        'eids': np.array([eid for _, eid in keyed], dtype=np.int32),
+        'texts': [e[0] for e in entries],
+        'kinds': [e[1] for e in entries],
+        'pop': np.array([e[2] for e in entries], dtype=np.float32),
+        'top': {},
+    }
+    prefixes = {k[:n] for k in index['keys'] for n in range(1, TOP_PREFIX_LEN + 1)}
+    for prefix in prefixes:
+        index['top'][prefix] = _complete_range(index, prefix, top_size)
+    return index
+
+
+def _complete_range(index, key, k):
+    """ the k most popular entries with a key starting with key, most popular first """
+    keys = index['keys']
+    lo = bisect_left(keys, key)
+    hi = bisect_left(keys, key + '\uffff', lo)
+    eids = index['eids'][lo:hi]
+    pop = index['pop'][eids]
+    # an author can appear under several keys, so keep some slack before deduping
+    m = 4*k
+    if m < len(eids):
+        part = np.argpartition(-pop, m)[:m]
+        eids, pop = eids[part], pop[part]
+    order = np.argsort(-pop, kind='stable')
+    eids = eids[order]
+    _, first = np.unique(eids, return_index=True)
+    return eids[np.sort(first)][:k]
+
+
+def completion_query(text):
+    """ what to search for when the completion text is picked, a quoted phrase """
+    return '"%s"' % (text.replace('"', ''), )
+
+
+def complete(index, q, k):
+    """ returns up to k (text, kind) completions of the prefix q, most popular first """
+    key = normalize_key(q)[:MAX_KEY_LEN]
+    if not key or k <= 0:
+        return []
+    if len(key) <= TOP_PREFIX_LEN:
+        eids = index['top'].get(key, [])[:k]
+    else:
+        eids = _complete_range(index, key, k)
+    return [(index['texts'][e], index['kinds'][e]) for e in eids]
@@ -1,33 +1,77 @@
 import os
+import re
 import json
+import gzip
+from functools import wraps
 from parse_papers_other import parse
 import time
+import queue
+import signal
+import threading
 import pickle
 import argparse
 import dateutil.parser
 from random import shuffle, randrange, uniform
 
 import numpy as np
+from scipy import sparse
 from sqlite3 import dbapi2 as sqlite3
 from hashlib import md5
+import hmac
 from flask import Flask, request, session, url_for, redirect, \
-    render_template, abort, g, flash, _app_ctx_stack
+    render_template as flask_render_template, abort, g, flash, jsonify, make_response, _app_ctx_stack
 from flask_limiter import Limiter
 from werkzeug.security import check_password_hash, generate_password_hash
 import pymongo
 import warnings
 warnings.filterwarnings('ignore')
 
-from utils import safe_pickle_dump, strip_version, isvalidid, Config, parse_time, flatten
+from utils import safe_pickle_dump, strip_version, isvalidid, Config, LRUCache, process_memory
+import search_index
+from snapshot import write_snapshot, load_snapshot_tree
+from async_serve import PREFETCH_KEY
+from prefork import Generations
+import metrics
+from metrics import span, timed
+import profiler
+
+# the json api uses orjson if it is installed, it is a lot faster
+try:
+    import orjson
+
+    def dumps_json(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps_json(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+# cached pages are also stored brotli compressed if it is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # various globals
 # -----------------------------------------------------------------------------
 
+# when serve.py started (after the imports), to log how long it takes to answer the first request
+START_TIME = time.time()
+FIRST_REQUEST = True
+
 # database configuration
 if os.path.isfile('secret_key.txt'):
     SECRET_KEY = open('secret_key.txt', 'r').read()
 else:
     SECRET_KEY = 'devkey, should be in a file'
+# key of the /admin endpoints, they are off without it
+ADMIN_KEY = None
+if os.path.isfile('admin_key.txt'):
+    ADMIN_KEY = open('admin_key.txt', 'r').read().strip()
+# key that asks for a profile of a request, see profiler.py. a key of its own, because
+# as the _profile argument it ends up in access logs
+PROFILE_KEY = None
+if os.path.isfile('profile_key.txt'):
+    PROFILE_KEY = open('profile_key.txt', 'r').read().strip()
 app = Flask(__name__)
 app.config.from_object(__name__)
 limiter = Limiter(app, global_limits=["1000 per hour", "200 per minute"])
@@ -38,15 +82,36 @@ limiter = Limiter(app, global_limits=["1000 per hour", "200 per minute"])
 # to initialize the database: sqlite3 as.db < schema.sql
 
 
+# idle connections, reused across requests. a request only ever uses one from one thread
+DB_POOL = queue.LifoQueue(maxsize=32)
+
+
 def connect_db():
-    sqlite_db = sqlite3.connect(Config.database_path)
+    sqlite_db = sqlite3.connect(Config.database_path, check_same_thread=False)
     sqlite_db.row_factory = sqlite3.Row  # to return dicts rather than tuples
+    # in WAL mode readers don't wait for the writes of /libtoggle and co
+    sqlite_db.execute('pragma journal_mode=wal')
+    sqlite_db.execute('pragma synchronous=normal')
+    sqlite_db.execute('pragma busy_timeout=5000')
+    # counts the statements of every request for /metrics
+    sqlite_db.set_trace_callback(metrics.count_sqlite)
     return sqlite_db
 
 
+def get_db():
+    """ the database connection of this request, taken from the pool on first use """
+    if 'db' not in g:
+        try:
+            g.db = DB_POOL.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
+    return g.db
+
+
+@timed('sqlite')
 def query_db(query, args=(), one=False):
     """Queries the database and returns a list of dictionaries."""
-    cur = g.db.execute(query, args)
+    cur = get_db().execute(query, args)
     rv = cur.fetchall()
     return (rv[0] if rv else None) if one else rv
 
@@ -69,105 +134,237 @@ def get_username(user_id):
 # -----------------------------------------------------------------------------
 
 
+def render_template(name, **context):
+    """ flask's render_template, timed for /metrics """
+    with span('render'):
+        return flask_render_template(name, **context)
+
+
 @app.before_request
 def before_request():
-    # this will always request database connection, even if we dont end up using it ;\
-    g.db = connect_db()
-    # retrieve user object from the database if user_id is set
+    # for /metrics. a prefetch of async_serve.py may have started counting already
+    g.start_time = time.perf_counter()
+    metrics.start_request(request.environ.get(metrics.COUNTS_KEY))
+    # a profile of this request, asked for with the profile key. see profiler.py
+    if PROFILE_KEY and ('X-Profile' in request.headers or b'_profile=' in request.query_string):
+        given = request.headers.get('X-Profile') or request.args.get('_profile', '')
+        if hmac.compare_digest(given.encode('utf-8'), PROFILE_KEY.encode('utf-8')):
+            g.profile_cpu = time.thread_time()
+            g.profiler = profiler.Sampler(threading.get_ident())
+    # the request answers from the snapshot that is current now, even if a reload
+    # swaps in a new one while it runs
+    g.snap = SNAPSHOT
+    # comments posted through another worker process, see prefork.py
+    if DISCUSSION_GENERATION.get() != DISCUSSION_SEEN:
+        with DISCUSSION_LOCK:
+            if DISCUSSION_GENERATION.get() != DISCUSSION_SEEN:
+                count_discussions()
+                PAGE_CACHE.clear()
+    # the database connection is only taken when a query needs it, see get_db
+    # retrieve user object if user_id is set. user rows never change, so they are cached
     g.user = None
     if 'user_id' in session:
-        g.user = query_db('select * from user where user_id = ?',
-                          [session['user_id']], one=True)
+        uid = session['user_id']
+        g.user = USER_CACHE.get(uid)
+        if g.user is None:
+            g.user = query_db('select * from user where user_id = ?', [uid], one=True)
+            if g.user is not None:
+                USER_CACHE.put(uid, g.user)
+    # api clients that already have the current answer get a 304 before we compute it
+    if request.path.startswith('/api/'):
+        g.etag = api_etag()
+        # a profiled request does the work it is profiled for
+        if request.if_none_match.contains(g.etag) and 'profiler' not in g:
+            resp = app.response_class(status=304)
+            resp.set_etag(g.etag)
+            return resp
+
+
+@app.after_request
+def after_request(resp):
+    if 'start_time' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.finish_request(route, request.method, str(resp.status_code), time.perf_counter() - g.start_time)
+        sampler = g.pop('profiler', None)
+        if sampler is not None:
+            meta = {'method': request.method, 'path': request.path, 'status': resp.status_code,
+                    'args': {k: v for k, v in request.args.items() if k != '_profile'},
+                    'user_id': session.get('user_id'), 'cpu_ms': (time.thread_time() - g.profile_cpu) * 1000,
+                    'snapshot': g.snap.version}
+            fname = profiler.save(sampler, Config.profile_dir, route, meta)
+            print('profiled %s %s into %s' % (request.method, request.path, fname))
+            resp.headers['X-Profile-File'] = fname
+    return resp
 
 
 @app.teardown_request
 def teardown_request(exception):
-    db = getattr(g, 'db', None)
+    sampler = g.pop('profiler', None)
+    if sampler is not None:
+        sampler.stop()  # the request failed before after_request
+    db = g.pop('db', None)
     if db is not None:
-        db.close()
+        # hand the connection back for the next request, without a half done transaction
+        db.rollback()
+        try:
+            DB_POOL.put_nowait(db)
+        except queue.Full:
+            db.close()
+    global FIRST_REQUEST
+    if FIRST_REQUEST:
+        FIRST_REQUEST = False
+        print('time to first request: %.2fs, %.2fs of it opening the snapshot' %
+              (time.time() - START_TIME, SNAPSHOT.load_time))
 
 # -----------------------------------------------------------------------------
 # search/sort functionality
 # -----------------------------------------------------------------------------
 
 
-def papers_search(qraw):
-    qparts = qraw.lower().strip().split()  # split by spaces
-    # use reverse index and accumulate scores
-    scores = []
-    for pid, p in db.items():
-        score = sum(SEARCH_DICT[pid].get(q, 0) for q in qparts)
-        if score == 0:
-            continue  # no match whatsoever, dont include
-        # give a small boost to more recent papers
-        score += 0.0001*p['tscore']
-        scores.append((score, p))
-    scores.sort(reverse=True, key=lambda x: x[0])  # descending
-    out = [x[1] for x in scores if x[0] > 0]
-    return out
-
-
+def get_facet_filters():
+    """ facet filters of the request: ?venue= and ?source= (repeatable), ?year=2019 or ?year=2017-2019 """
+    filters = {}
+    for name in ('venue', 'source'):
+        values = request.args.getlist(name)
+        if values:
+            filters[name] = values
+    m = re.match(r'^(\d{4})(?:-(\d{4}))?$', request.args.get('year', ''))
+    if m:
+        filters['year'] = (int(m.group(1)), int(m.group(2) or m.group(1)))
+    return filters
+
+
+@timed('facets')
+def facet_filter(pids, filters):
+    """ the pids passing the facet filters, and the facet counts of the pids """
+    snap = g.snap
+    rows = snap.db.field_values('_row', pids)
+    mask, counts = search_index.filter_facets(snap.search_index, rows, filters)
+    if mask is not None:
+        pids = [pid for pid, ok in zip(pids, mask) if ok]
+    return pids, counts
+
+
+def match_query(qparts, phrases, mode):
+    """ (rows, scores) of the papers matching the query, in the given ranking mode """
+    snap = g.snap
+    if mode == 'tfidf' and snap.tfidf_x is not None:
+        # cosine similarity with the tfidf vectors, consistent with the svm and similarities
+        return search_index.tfidf_match(snap.search_index, snap.tfidf_x, snap.vocab, snap.idf, qparts, phrases=phrases)
+    # only walk the postings of the query terms
+    return search_index.match(snap.search_index, qparts, phrases=phrases)
+
+
+@timed('search')
+def pids_search(qraw, n, filters, mode='words'):
+    """
+    returns the top n pids for the query, the total number of matches, the
+    spelling corrections ({term: [similar terms]}) that were searched as well
+    and the facet counts of the matches.
+    "quoted phrases" in the query must all appear in the paper.
+    mode is 'words' (weighted term match) or 'tfidf' (cosine similarity).
+    """
+    snap = g.snap
+    # popular queries are answered from the cache, keyed on the normalized query.
+    # a cached ranking can answer any page that lies within it. a profiled request
+    # searches again, a profile of a cache hit shows nothing
+    qkey = (snap.version, search_index.normalize_query(qraw), repr(sorted(filters.items())), mode)
+    cached = SEARCH_CACHE.get(qkey) if 'profiler' not in g else None
+    if cached is None or len(cached[0]) < min(n, cached[1]):
+        qparts, phrases = search_index.parse_query(qkey[1])
+        rows, scores = match_query(qparts, phrases, mode)
+        corrections = {}
+        if len(rows) < search_index.FUZZY_MIN_HITS:
+            # (almost) nothing found, maybe a typo. also search similarly spelled terms
+            corrections = search_index.correct_terms(snap.search_index, qparts)
+            if corrections:
+                extra = [t for ts in corrections.values() for t in ts]
+                rows, scores = match_query(qparts + extra, phrases, mode)
+        mask, counts = search_index.filter_facets(snap.search_index, rows, filters)
+        if mask is not None:
+            rows, scores = rows[mask], scores[mask]
+        pids = snap.search_index['pids']
+        cached = ([pids[i] for i in search_index.top_k(rows, scores, n)], len(rows), corrections, counts)
+        SEARCH_CACHE.put(qkey, cached)
+    pids, total, corrections, counts = cached
+    return pids[:n], total, corrections, counts
+
+
+@timed('similar')
 def papers_similar(pid):
+    snap = g.snap
     rawpid = strip_version(pid)
-    return []
 
     # check if we have this paper at all, otherwise return empty list
-    if not rawpid in db:
+    if not rawpid in snap.db:
         return []
 
-    # check if we have distances to this specific version of paper id (includes version)
-    if pid in sim_dict:
-        # good, simplest case: lets return the papers
-        return [db[strip_version(k)] for k in sim_dict[pid]]
-    else:
-        # ok we don't have this specific version. could be a stale URL that points to,
-        # e.g. v1 of a paper, but due to an updated version of it we only have v2 on file
-        # now. We want to use v2 in that case.
-        # lets try to retrieve the most recent version of this paper we do have
-        kok = [k for k in sim_dict if rawpid in k]
-        if kok:
-            # ok we have at least one different version of this paper, lets use it instead
-            id_use_instead = kok[0]
-            return [db[strip_version(k)] for k in sim_dict[id_use_instead]]
-        else:
-            # return just the paper. we dont have similarities for it for some reason
-            return [db[rawpid]]
+    # neighbors are stored per db key, i.e. without the version, so a stale URL
+    # that points to e.g. v1 of a paper we now only have as v2 finds them too
+    if snap.ann is not None:
+        found = snap.ann.query_key(rawpid, 50)
+        if found is not None:
+            return [snap.db[k] for k in found[0] if k in snap.db]
+    # the snapshot keeps the neighbors of every paper as rows of the paper store, itself first
+    row = snap.db.row(rawpid)
+    rows = [] if snap.sim is None else [r for r in snap.sim[row] if r >= 0]
+    if not rows:
+        # return just the paper. we dont have similarities for it for some reason
+        return [snap.db.record(row)]
+    return [snap.db.record(r) for r in rows]
+
+
+def get_library(uid):
+    """
+    the set of raw pids in the library of a user. read from the database once
+    and then cached. the cached set is a frozenset that is never changed,
+    /libtoggle stores a new one, so readers can iterate it without the lock.
+    a toggle in another worker process bumps the generation of the library, see prefork.py
+    """
+    cached = LIBRARY_CACHE.get(uid)
+    if cached is not None and cached[0] == LIBRARY_GENERATIONS.get(uid):
+        return cached[1]
+    # read under the lock, so we can't cache a library from before a toggle committed
+    with LIBRARY_LOCK:
+        generation = LIBRARY_GENERATIONS.get(uid)
+        user_library = query_db(
+            '''select paper_id from library where user_id = ?''', [uid])
+        libids = frozenset(strip_version(x['paper_id']) for x in user_library)
+        LIBRARY_CACHE.put(uid, (generation, libids))
+    return libids
 
 
-def papers_from_library():
+def pids_from_library():
+    db = g.snap.db
     out = []
     if g.user:
         # user is logged in, lets fetch their saved library data
-        uid = session['user_id']
-        user_library = query_db(
-            '''select * from library where user_id = ?''', [uid])
-        libids = [strip_version(x['paper_id']) for x in user_library]
-        out = [db[x] for x in libids]
-        out = sorted(out, key=lambda k: k['updated'], reverse=True)
+        libids = get_library(session['user_id'])
+        out = sorted(libids, key=lambda k: db[k].updated, reverse=True)
     return out
 
 
-def papers_from_svm(recent_days=None):
+@timed('recommend')
+def pids_from_svm(recent_days=None):
+    snap = g.snap
     out = []
     if g.user:
 
         uid = session['user_id']
-        if not uid in user_sim:
+        if not uid in snap.user_sim:
             return []
 
         # we want to exclude papers that are already in user library from the result, so fetch them.
-        user_library = query_db(
-            '''select * from library where user_id = ?''', [uid])
-        libids = {strip_version(x['paper_id']) for x in user_library}
+        libids = get_library(uid)
 
-        plist = user_sim[uid]
-        out = [db[x] for x in plist if not x in libids]
+        plist = snap.user_sim[uid]
+        out = [x for x in plist if not x in libids]
 
         if recent_days is not None:
             # filter as well to only most recent papers
             curtime = int(time.time())  # in seconds
-            out = [x for x in out if curtime -
-                   x['time_published'] < recent_days*24*60*60]
+            published = snap.db.field_values('time_published', out)
+            out = [x for x, t in zip(out, published) if curtime - t < recent_days*24*60*60]
 
     return out
 
@@ -177,67 +374,31 @@ def papers_filter_version(papers, v):
     if v != '1':
         return papers  # noop
     intv = int(v)
-    filtered = [p for p in papers if p['_version'] == intv]
+    filtered = [p for p in papers if p.version == intv]
     return filtered
 
 
+@timed('encode_json')
 def encode_json(ps, n=10, send_images=False, send_abstracts=True):
 
     libids = set()
     if g.user:
         # user is logged in, lets fetch their saved library data
-        uid = session['user_id']
-        user_library = query_db(
-            '''select * from library where user_id = ?''', [uid])
-        libids = {strip_version(x['paper_id']) for x in user_library}
+        libids = get_library(session['user_id'])
 
     ret = []
     for i in range(min(len(ps), n)):
         p = ps[i]
-        if '_rawid' in p:
-            idvv = '%sv%d' % (p['_rawid'], p['_version'])
-        else:
-            idvv = p['url'].replace('/','').replace(':','')
-        struct = {}
-        struct['title'] = p['title']
-        struct['pid'] = idvv
-        struct['rawpid'] = p.get('_rawid','')
-        #struct['category'] = p['arxiv_primary_category']['term']
-        if 'authors' in p:
-            struct['authors'] = [a['name'] for a in p['authors']]
-        else:
-            struct['authors'] = p['author']
-        struct['affiliation'] = '; '.join(list(set(flatten(p.get('affiliation', [])))))
-        if 'link' in p:
-            struct['link'] = p['link']
-        else:
-            struct['link'] = p['url']
-        struct['in_library'] = 1 #if p['_rawid'] in libids else 0
-        if send_abstracts:
-            struct['abstract'] = p.get('summary', '')
+        # the static fields are precomputed by make_cache.py
+        struct = p.display()
+        struct['in_library'] = 1 if p.rawid in libids else 0
+        if not send_abstracts:
+            del struct['abstract']
         if send_images:
-            struct['img'] = '/static/thumbs/' + idvv + '.pdf.jpg'
-        #struct['tags'] = [t['term'] for t in p['tags']]
-        struct['conf_full_name'] = p.get('conf_full_name', 'arXiv')
-        if len(struct['conf_full_name']) > 24:
-            struct['conf_full_name_trunc'] = struct['conf_full_name'][:24]+'...'
-        else:
-            struct['conf_full_name_trunc'] = struct['conf_full_name']
-            
-        # render time information nicely
-        timestruct = parse_time(p.get('published',Config.default_published_time))
-        struct['published_time'] = '%s/%s/%s' % (
-            timestruct.month, timestruct.day, timestruct.year)
+            struct['img'] = '/static/thumbs/' + struct['pid'] + '.pdf.jpg'
 
-        # fetch amount of discussion on this paper
-        struct['num_discussion'] = comments.count({ 'pid': struct['pid'] })
-
-
-        # arxiv comments from the authors (when they submit the paper)
-        cc = p.get('arxiv_comment', '')
-        if len(cc) > 100:
-            cc = cc[:100] + '...'  # crop very long comments
-        struct['comment'] = cc
+        # amount of discussion on this paper, comments are stored under the db key
+        struct['num_discussion'] = DISCUSSION_COUNTS.get(p.key, 0)
 
         ret.append(struct)
     return ret
@@ -247,8 +408,20 @@ def encode_json(ps, n=10, send_images=False, send_abstracts=True):
 # -----------------------------------------------------------------------------
 
 
+def get_page(pids):
+    """
+    the slice of pids requested with the ?start= cursor, and the cursor of the
+    next page (None on the last page). only this slice gets materialized and encoded.
+    """
+    start = max(request.args.get('start', 0, type=int), 0)
+    page = pids[start:start + args.num_results]
+    next_start = start + len(page) if start + len(page) < len(pids) else None
+    return page, next_start
+
+
 def default_context(papers, **kws):
-    top_papers = encode_json(papers, args.num_results)
+    db = g.snap.db
+    top_papers = encode_json(papers, len(papers))
 
     # prompt logic
     show_prompt = 'no'
@@ -257,20 +430,64 @@ def default_context(papers, **kws):
             uid = session['user_id']
             entry = goaway_collection.find_one({'uid': uid})
             if not entry:
-                lib_count = query_db(
-                    '''select count(*) from library where user_id = ?''', [uid], one=True)
-                lib_count = lib_count['count(*)']
-                if lib_count > 0:  # user has some items in their library too
+                if get_library(uid):  # user has some items in their library too
                     show_prompt = 'yes'
     except Exception as e:
         print(e)
 
     ans = dict(papers=top_papers, numresults=len(papers), totpapers=len(
-        db), tweets=[], msg='', show_prompt=show_prompt, pid_to_users={})
+        db), tweets=[], msg='', show_prompt=show_prompt, pid_to_users={}, next_start=None,
+        facets={})
     ans.update(kws)
     return ans
 
 
+def snapshot_version():
+    """ identifies the data files the server loads, changes whenever the pipeline rewrites one of them """
+    h = md5()
+    for path in (Config.snapshot_path, Config.ann_path):
+        if os.path.isfile(path):
+            st = os.stat(path)
+            h.update(('%s:%d:%d;' % (path, st.st_mtime_ns, st.st_size)).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def api_etag():
+    """
+    strong etag of an /api/v1 request, derived from what its answer depends on
+    (the data snapshot, the discussion counts, the user's library, the query)
+    without computing the answer itself
+    """
+    parts = [g.snap.version, str(DISCUSSION_TOTAL), request.full_path]
+    if g.user:
+        uid = session['user_id']
+        parts.append('%d:%s' % (uid, ','.join(sorted(get_library(uid)))))
+    if request.endpoint in ('top', 'recommend'):
+        # these filter by the age of papers, so they also change as time passes
+        parts.append(str(int(time.time()) // 3600))
+    return md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def api_response(obj):
+    with span('dumps_json'):
+        body = dumps_json(obj)
+    resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(g.etag)
+    # clients and caches may keep it, but have to revalidate with the etag
+    resp.headers['Cache-Control'] = ('private' if g.user else 'public') + ', no-cache'
+    return resp
+
+
+def render_papers(ctx):
+    """ renders the page, or only the papers of the page for the infinite scroll """
+    if request.path.startswith('/api/'):
+        return api_response({k: ctx[k] for k in ('papers', 'numresults', 'next_start', 'pid_to_users',
+                                                 'facets', 'msg')})
+    if request.args.get('format') == 'json':
+        return jsonify({k: ctx[k] for k in ('papers', 'numresults', 'next_start', 'pid_to_users')})
+    return render_template('main.html', **ctx)
+
+
 @app.route('/goaway', methods=['POST'])
 def goaway():
     if not g.user:
@@ -284,14 +501,58 @@ def goaway():
     return 'OK'
 
 
+def anonymous_page_cache(view):
+    """
+    caches the whole response of a view for anonymous visitors, who all see the
+    same page. keyed on the path and query args, and stored already compressed,
+    so a hit does no work at all. logged in users, pending flashes and
+    profiled requests skip it
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if g.user or session.get('_flashes') or request.path.startswith('/api/') or 'profiler' in g:
+            return view(*args, **kwargs)
+        key = (g.snap.version, request.path, tuple(sorted(request.args.items(multi=True))))
+        entry = PAGE_CACHE.get(key)
+        if entry is None:
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+            body = resp.get_data()
+            entry = {'mimetype': resp.mimetype, 'identity': body, 'gzip': gzip.compress(body, 6)}
+            if brotli is not None:
+                entry['br'] = brotli.compress(body, quality=5)
+            PAGE_CACHE.put(key, entry)
+        encoding = 'identity'
+        for enc in ('br', 'gzip'):
+            if enc in entry and request.accept_encodings[enc]:
+                encoding = enc
+                break
+        resp = app.response_class(entry[encoding], mimetype=entry['mimetype'])
+        if encoding != 'identity':
+            resp.headers['Content-Encoding'] = encoding
+        resp.vary.add('Accept-Encoding')
+        resp.vary.add('Cookie')
+        return resp
+    # so async_serve.py knows not to prefetch for the visitors the cache answers
+    wrapped.page_cached = True
+    return wrapped
+
+
 @app.route("/")
+@app.route("/api/v1/recent")
+@anonymous_page_cache
 def intmain():
+    snap = g.snap
     vstr = request.args.get('vfilter', 'all')
-    papers = [db[pid] for pid in DATE_SORTED_PIDS]  # precomputed
-    papers = papers_filter_version(papers, vstr)
-    ctx = default_context(papers, render_format='recent',
-                          msg='Showing most recent Arxiv papers:')
-    return render_template('main.html', **ctx)
+    # rows of the search index are in date order too, so we can filter them directly
+    mask, facets = search_index.filter_facets(snap.search_index, None, get_facet_filters())
+    rows = snap.all_rows if mask is None else np.flatnonzero(mask)
+    page, next_start = get_page(rows)
+    papers = papers_filter_version([snap.db[snap.date_sorted_pids[r]] for r in page], vstr)
+    ctx = default_context(papers, render_format='recent', numresults=len(rows), next_start=next_start,
+                          facets=facets, msg='Showing most recent Arxiv papers:')
+    return render_papers(ctx)
 
 
 @app.route("/<request_pid>")
@@ -303,26 +564,41 @@ def rank(request_pid=None):
     return render_template('main.html', **ctx)
 
 
+@app.route("/api/v1/paper/<request_pid>")
+def api_paper(request_pid):
+    """ a paper and its most similar papers """
+    if not isvalidid(request_pid):
+        return api_response({'papers': [], 'numresults': 0})
+    papers = papers_similar(request_pid)
+    return api_response({'papers': encode_json(papers, len(papers)), 'numresults': len(papers)})
+
+
 @app.route('/discuss', methods=['GET'])
 def discuss():
     """ return discussion related to a paper """
+    db = g.snap.db
     pid = request.args.get('id', '')  # paper id of paper we wish to discuss
     papers = [db[pid]] if pid in db else []
 
-    # fetch the comments
-    comms_cursor = comments.find({'pid': pid}).sort(
-        [('time_posted', pymongo.DESCENDING)])
-    comms = list(comms_cursor)
-    for c in comms:
-        # have to convert these to strs from ObjectId, and backwards later http://api.mongodb.com/python/current/tutorial.html
-        c['_id'] = str(c['_id'])
-
-    # fetch the counts for all tags
-    tag_counts = []
-    for c in comms:
-        cc = [tags_collection.count(
-            {'comment_id': c['_id'], 'tag_name':t}) for t in TAGS]
-        tag_counts.append(cc)
+    prefetch = request.environ.get(PREFETCH_KEY)
+    if prefetch is not None:
+        # under --prod async_serve.py already fetched them without blocking
+        comms, tag_counts = prefetch['comments'], prefetch['tag_counts']
+    else:
+        # fetch the comments
+        comms_cursor = comments.find({'pid': pid}).sort(
+            [('time_posted', pymongo.DESCENDING)])
+        comms = list(comms_cursor)
+        for c in comms:
+            # have to convert these to strs from ObjectId, and backwards later http://api.mongodb.com/python/current/tutorial.html
+            c['_id'] = str(c['_id'])
+
+        # fetch the counts for all tags
+        tag_counts = []
+        for c in comms:
+            cc = [tags_collection.count_documents(
+                {'comment_id': c['_id'], 'tag_name':t}) for t in TAGS]
+            tag_counts.append(cc)
 
     # and render
     ctx = default_context(papers, render_format='default',
@@ -333,6 +609,8 @@ def discuss():
 @app.route('/comment', methods=['POST'])
 def comment():
     """ user wants to post a comment """
+    global DISCUSSION_TOTAL, DISCUSSION_SEEN
+    db = g.snap.db
     anon = int(request.form['anon'])
 
     if g.user and (not anon):
@@ -346,7 +624,7 @@ def comment():
         pid = request.form['pid']
         if not pid in db:
             raise Exception("invalid pid")
-        version = db[pid]['_version']  # most recent version of this paper
+        version = db[pid].version  # most recent version of this paper
     except Exception as e:
         print(e)
         return 'bad pid. This is most likely Andrej\'s fault.'
@@ -365,14 +643,27 @@ def comment():
     # enter into database
     print(entry)
     comments.insert_one(entry)
+    with DISCUSSION_LOCK:
+        DISCUSSION_COUNTS[pid] = DISCUSSION_COUNTS.get(pid, 0) + 1
+        DISCUSSION_TOTAL += 1
+        # the other workers count again. we don't need to if nobody else posted meanwhile
+        if DISCUSSION_GENERATION.bump() == DISCUSSION_SEEN + 1:
+            DISCUSSION_SEEN += 1
+    # cached pages show the old discussion counts
+    PAGE_CACHE.clear()
     return 'OK'
 
 
 @app.route("/discussions", methods=['GET'])
 def discussions():
+    db = g.snap.db
     # return most recently discussed papers
-    comms_cursor = comments.find().sort(
-        [('time_posted', pymongo.DESCENDING)]).limit(100)
+    prefetch = request.environ.get(PREFETCH_KEY)
+    if prefetch is not None:
+        comms_cursor = prefetch['comments']
+    else:
+        comms_cursor = comments.find().sort(
+            [('time_posted', pymongo.DESCENDING)]).limit(100)
 
     # get the (unique) set of papers.
     papers = []
@@ -425,52 +716,127 @@ def toggletag():
 
 
 @app.route("/search", methods=['GET'])
+@app.route("/api/v1/search", methods=['GET'])
 def search():
+    db = g.snap.db
     q = request.args.get('q', '')  # get the search request
-    papers = papers_search(q)  # perform the query and get sorted documents
-    ctx = default_context(papers, render_format="search")
-    return render_template('main.html', **ctx)
+    start = max(request.args.get('start', 0, type=int), 0)
+    mode = 'tfidf' if request.args.get('mode') == 'tfidf' else 'words'
+    # perform the query and get the sorted documents up to the end of this page
+    pids, numresults, corrections, facets = pids_search(q, start + args.num_results, get_facet_filters(), mode)
+    pids = pids[start:]
+    next_start = start + len(pids) if start + len(pids) < numresults else None
+    papers = [db[pid] for pid in pids]
+    msg = ''
+    if corrections:
+        msg = 'Few exact matches, also showing results for: %s' % (
+            ', '.join(t for ts in corrections.values() for t in ts), )
+    ctx = default_context(papers, render_format="search", numresults=numresults,
+                          next_start=next_start, facets=facets, msg=msg)
+    return render_papers(ctx)
+
+
+@app.route("/autocomplete", methods=['GET'])
+@limiter.limit("10000 per hour;1000 per minute")  # fired on every keystroke
+def autocomplete():
+    """ most popular titles, authors and venues starting with the typed prefix """
+    snap = g.snap
+    q = request.args.get('q', '')
+    n = max(1, min(request.args.get('n', 10, type=int), 20))
+    out = []
+    for text, kind in search_index.complete(snap.prefix_index, q, n):
+        # what to search for when the completion is picked
+        out.append({'text': text, 'kind': kind, 'q': search_index.completion_query(text)})
+    return jsonify(out)
+
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    """ counters of the in-process caches, and the memory of this (worker) process """
+    memory = process_memory()
+    return jsonify({'search_cache': SEARCH_CACHE.stats(), 'library_cache': LIBRARY_CACHE.stats(),
+                    'page_cache': PAGE_CACHE.stats(), 'pid': os.getpid(),
+                    'memory': None if memory is None else {'uss_mb': memory[0], 'pss_mb': memory[1]}})
+
+
+@app.route("/metrics", methods=['GET'])
+@limiter.exempt
+def metrics_page():
+    """ latency histograms and counters of this (worker) process in the prometheus text format """
+    return app.response_class(metrics.expose(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """
+    loads the data files again in the background, e.g. for the pipeline to call
+    when it is done. with --workers in all of them, not just the one answering
+    """
+    key = request.form.get('key', '')
+    if ADMIN_KEY is None or not hmac.compare_digest(key.encode('utf-8'), ADMIN_KEY.encode('utf-8')):
+        abort(403)
+    if MASTER_PID is not None and os.getppid() == MASTER_PID:
+        # every worker reloads, the master passes SIGHUP on to all of them. see prefork.py
+        os.kill(MASTER_PID, signal.SIGHUP)
+    else:
+        RELOAD_EVENT.set()
+    return jsonify({'reloading': True, 'version': SNAPSHOT.version}), 202
 
 
 @app.route('/recommend', methods=['GET'])
+@app.route('/api/v1/recommend', methods=['GET'])
 def recommend():
     """ return user's svm sorted list """
+    db = g.snap.db
     ttstr = request.args.get('timefilter', 'week')  # default is week
     vstr = request.args.get('vfilter', 'all')  # default is all (no filter)
     legend = {'day': 1, '3days': 3, 'week': 7, 'month': 30, 'year': 365}
     tt = legend.get(ttstr, None)
-    papers = papers_from_svm(recent_days=tt)
-    papers = papers_filter_version(papers, vstr)
-    ctx = default_context(papers, render_format='recommend',
+    all_pids, facets = facet_filter(pids_from_svm(recent_days=tt), get_facet_filters())
+    pids, next_start = get_page(all_pids)
+    papers = papers_filter_version([db[pid] for pid in pids], vstr)
+    ctx = default_context(papers, render_format='recommend', numresults=len(all_pids), next_start=next_start,
+                          facets=facets,
                           msg='Recommended papers: (based on SVM trained on tfidf of papers in your library, refreshed every day or so)' if g.user else 'You must be logged in and have some papers saved in your library.')
-    return render_template('main.html', **ctx)
+    return render_papers(ctx)
 
 
 @app.route('/top', methods=['GET'])
+@app.route('/api/v1/top', methods=['GET'])
+@anonymous_page_cache
 def top():
     """ return top papers """
+    snap = g.snap
     ttstr = request.args.get('timefilter', 'week')  # default is week
     vstr = request.args.get('vfilter', 'all')  # default is all (no filter)
     legend = {'day': 1, '3days': 3, 'week': 7,
               'month': 30, 'year': 365, 'alltime': 10000}
     tt = legend.get(ttstr, 7)
     curtime = int(time.time())  # in seconds
-    top_sorted_papers = [db[p] for p in TOP_SORTED_PIDS]
-    papers = [p for p in top_sorted_papers if curtime -
-              p['time_published'] < tt*24*60*60]
-    papers = papers_filter_version(papers, vstr)
-    ctx = default_context(papers, render_format='top',
+    recent = curtime - snap.top_published < tt*24*60*60
+    all_pids = [p for p, ok in zip(snap.top_sorted_pids, recent) if ok]
+    all_pids, facets = facet_filter(all_pids, get_facet_filters())
+    pids, next_start = get_page(all_pids)
+    papers = papers_filter_version([snap.db[pid] for pid in pids], vstr)
+    ctx = default_context(papers, render_format='top', numresults=len(all_pids), next_start=next_start,
+                          facets=facets,
                           msg='Top papers based on people\'s libraries:')
-    return render_template('main.html', **ctx)
+    return render_papers(ctx)
 
 
 @app.route('/toptwtr', methods=['GET'])
+@anonymous_page_cache
 def toptwtr():
     """ return top papers """
+    db = g.snap.db
     ttstr = request.args.get('timefilter', 'day')  # default is day
-    tweets_top = {'day': tweets_top1,
-                  'week': tweets_top7, 'month': tweets_top30}[ttstr]
-    cursor = tweets_top.find().sort([('vote', pymongo.DESCENDING)]).limit(100)
+    prefetch = request.environ.get(PREFETCH_KEY)
+    if prefetch is not None:
+        cursor = prefetch['tweets']
+    else:
+        tweets_top = {'day': tweets_top1,
+                      'week': tweets_top7, 'month': tweets_top30}[ttstr]
+        cursor = tweets_top.find().sort([('vote', pymongo.DESCENDING)]).limit(100)
     papers, tweets = [], []
     for rec in cursor:
         if rec['pid'] in db:
@@ -483,22 +849,26 @@ def toptwtr():
 
 
 @app.route('/library')
+@app.route('/api/v1/library')
 def library():
     """ render user's library """
-    papers = papers_from_library()
-    # cap at 500 papers in someone's library. that's a lot!
-    ret = encode_json(papers, 500)
+    db = g.snap.db
+    all_pids, facets = facet_filter(pids_from_library(), get_facet_filters())
+    pids, next_start = get_page(all_pids)
+    papers = [db[pid] for pid in pids]
     if g.user:
-        msg = '%d papers in your library:' % (len(ret), )
+        msg = '%d papers in your library:' % (len(all_pids), )
     else:
         msg = 'You must be logged in. Once you are, you can save papers to your library (with the save icon on the right of each paper) and they will show up here.'
-    ctx = default_context(papers, render_format='library', msg=msg)
-    return render_template('main.html', **ctx)
+    ctx = default_context(papers, render_format='library', numresults=len(all_pids),
+                          next_start=next_start, facets=facets, msg=msg)
+    return render_papers(ctx)
 
 
 @app.route('/libtoggle', methods=['POST'])
 def review():
     """ user wants to toggle a paper in his library """
+    db = g.snap.db
 
     # make sure user is logged in
     if not g.user:
@@ -514,40 +884,49 @@ def review():
 
     uid = session['user_id']  # id of logged in user
 
-    # check this user already has this paper in library
-    record = query_db('''select * from library where
-          user_id = ? and paper_id = ?''', [uid, pid], one=True)
-    print(record)
-
-    ret = 'NO'
-    if record:
-        # record exists, erase it.
-        g.db.execute(
-            '''delete from library where user_id = ? and paper_id = ?''', [uid, pid])
-        g.db.commit()
-        #print('removed %s for %s' % (pid, uid))
-        ret = 'OFF'
-    else:
-        # record does not exist, add it.
-        rawpid = strip_version(pid)
-        g.db.execute('''insert into library (paper_id, user_id, update_time) values (?, ?, ?)''',
-                     [rawpid, uid, int(time.time())])
-        g.db.commit()
-        #print('added %s for %s' % (pid, uid))
-        ret = 'ON'
+    # the lock keeps the cached library in step with the database
+    with LIBRARY_LOCK:
+        generation = LIBRARY_GENERATIONS.get(uid)
+        libids = get_library(uid)
+        # check this user already has this paper in library
+        if pid in libids:
+            # record exists, erase it.
+            get_db().execute(
+                '''delete from library where user_id = ? and paper_id = ?''', [uid, pid])
+            get_db().commit()
+            libids = libids - {pid}
+            #print('removed %s for %s' % (pid, uid))
+            ret = 'OFF'
+        else:
+            # record does not exist, add it.
+            get_db().execute('''insert into library (paper_id, user_id, update_time) values (?, ?, ?)''',
+                         [pid, uid, int(time.time())])
+            get_db().commit()
+            libids = libids | {pid}
+            #print('added %s for %s' % (pid, uid))
+            ret = 'ON'
+        # the other workers drop their copy. ours is only current if nobody else toggled meanwhile
+        if LIBRARY_GENERATIONS.bump(uid) == generation + 1:
+            LIBRARY_CACHE.put(uid, (generation + 1, libids))
+        else:
+            LIBRARY_CACHE.pop(uid)
 
     return ret
 
 
 @app.route('/friends', methods=['GET'])
 def friends():
+    db = g.snap.db
 
     ttstr = request.args.get('timefilter', 'week')  # default is week
     legend = {'day': 1, '3days': 3, 'week': 7, 'month': 30, 'year': 365}
     tt = legend.get(ttstr, 7)
 
-    papers = []
+    pids = []
+    numresults = 0
+    next_start = None
     pid_to_users = {}
+    facets = {}
     if g.user:
         # gather all the people we are following
         username = get_username(session['user_id'])
@@ -556,10 +935,7 @@ def friends():
         counts = {}
         for edict in edges:
             whom = edict['whom']
-            uid = get_user_id(whom)
-            user_library = query_db(
-                '''select * from library where user_id = ?''', [uid])
-            libids = [strip_version(x['paper_id']) for x in user_library]
+            libids = get_library(get_user_id(whom))
             for lid in libids:
                 if not lid in counts:
                     counts[lid] = []
@@ -568,33 +944,36 @@ def friends():
         keys = list(counts.keys())
         # descending by count
         keys.sort(key=lambda k: len(counts[k]), reverse=True)
-        papers = [db[x] for x in keys]
         # finally filter by date
         curtime = int(time.time())  # in seconds
-        papers = [x for x in papers if curtime -
-                  x['time_published'] < tt*24*60*60]
+        published = db.field_values('time_published', keys)
+        keys = [x for x, t in zip(keys, published) if curtime - t < tt*24*60*60]
         # trim at like 100
-        if len(papers) > 100:
-            papers = papers[:100]
+        if len(keys) > 100:
+            keys = keys[:100]
+        keys, facets = facet_filter(keys, get_facet_filters())
+        numresults = len(keys)
+        pids, next_start = get_page(keys)
         # trim counts as well correspondingly
-        pid_to_users = {p['_rawid']: counts.get(
-            p['_rawid'], []) for p in papers}
+        pid_to_users = {pid: counts.get(pid, []) for pid in pids}
 
+    papers = [db[pid] for pid in pids]
     if not g.user:
         msg = "You must be logged in and follow some people to enjoy this tab."
     else:
-        if len(papers) == 0:
+        if numresults == 0:
             msg = "No friend papers present. Try to extend the time range, or add friends by clicking on your account name (top, right)"
         else:
             msg = "Papers in your friend's libraries:"
 
-    ctx = default_context(papers, render_format='friends',
-                          pid_to_users=pid_to_users, msg=msg)
-    return render_template('main.html', **ctx)
+    ctx = default_context(papers, render_format='friends', numresults=numresults,
+                          next_start=next_start, pid_to_users=pid_to_users, facets=facets, msg=msg)
+    return render_papers(ctx)
 
 
 @app.route('/account')
 def account():
+    db = g.snap.db
     ctx = {'totpapers': len(db)}
 
     followers = []
@@ -700,12 +1079,12 @@ def login():
     else:
         # create account and log in
         creation_time = int(time.time())
-        g.db.execute('''insert into user (username, pw_hash, creation_time) values (?, ?, ?)''',
+        get_db().execute('''insert into user (username, pw_hash, creation_time) values (?, ?, ?)''',
                      [request.form['username'],
                       generate_password_hash(request.form['password']),
                       creation_time])
-        user_id = g.db.execute('select last_insert_rowid()').fetchall()[0][0]
-        g.db.commit()
+        user_id = get_db().execute('select last_insert_rowid()').fetchall()[0][0]
+        get_db().commit()
 
         session['user_id'] = user_id
         flash('New account %s created' % (request.form['username'], ))
@@ -720,6 +1099,114 @@ def logout():
     return redirect(url_for('intmain'))
 
 
+# -----------------------------------------------------------------------------
+# loading of the precomputed data
+# -----------------------------------------------------------------------------
+
+
+class Snapshot(object):
+    """
+    the data files of the pipeline as the server uses them: the papers, the
+    search index and sorted lists, the similarities and the recommendations.
+    a request takes the current snapshot once (g.snap) and only uses that one
+    """
+    pass
+
+
+def count_discussions():
+    """
+    counts the comments of every paper, so rendering a page doesn't need a count
+    query per paper. /comment keeps the counts up to date, and they are counted
+    again when a comment was posted through another worker process
+    """
+    global DISCUSSION_COUNTS, DISCUSSION_TOTAL, DISCUSSION_SEEN
+    seen = DISCUSSION_GENERATION.get()
+    counts = {d['_id']: d['n'] for d in comments.aggregate(
+        [{'$group': {'_id': '$pid', 'n': {'$sum': 1}}}])}
+    DISCUSSION_COUNTS, DISCUSSION_TOTAL, DISCUSSION_SEEN = counts, sum(counts.values()), seen
+
+
+def load_snapshot():
+    """ opens the snapshot of make_cache.py as a new Snapshot, without touching the one being served """
+    t0 = time.time()
+    snap = Snapshot()
+    # taken before loading, so files rewritten while we load get a new version on the next check
+    snap.version = snapshot_version()
+    if not os.path.isfile(Config.snapshot_path):
+        # the pickles of an older make_cache.py, convert them once
+        print('did not find', Config.snapshot_path, 'so converting', Config.db_serve_path, 'and co')
+        db = pickle.load(open(Config.db_serve_path, 'rb'))
+        write_snapshot(db, pickle.load(open(Config.serve_cache_path, 'rb')), pickle.load(open(Config.meta_path, 'rb')))
+        del db
+    # everything is memory mapped and only read when a request needs it
+    print('opening snapshot', Config.snapshot_path)
+    _, tree = load_snapshot_tree()
+    snap.db = tree['db']
+    snap.date_sorted_pids = tree['date_sorted_pids']
+    snap.top_sorted_pids = tree['top_sorted_pids']
+    snap.top_published = tree['top_published']
+    snap.search_index = tree['search_index']
+    snap.prefix_index = tree['prefix_index']
+    snap.vocab = tree['vocab']
+    snap.idf = tree['idf']
+    snap.all_rows = np.arange(len(snap.date_sorted_pids))
+    snap.tfidf_x = None
+    if 'tfidf' in tree:
+        t = tree['tfidf']
+        snap.tfidf_x = sparse.csc_matrix((t['data'], t['indices'], t['indptr']),
+                                         shape=tuple(int(n) for n in t['shape']), copy=False)
+    else:
+        print('the snapshot has no tfidf matrix, so mode=tfidf searches will use the default ranking')
+    snap.sim = tree.get('sim')
+    snap.user_sim = tree['user_sim']
+    snap.ann = None
+    if args.ann:
+        print('loading the approximate nearest neighbor index', Config.ann_path)
+        snap.ann = pickle.load(open(Config.ann_path, 'rb'))
+    snap.load_time = time.time() - t0
+    print('opened snapshot in %.2fs' % (snap.load_time, ))
+    return snap
+
+
+def swap_snapshot(snap):
+    """ new requests use snap from now on, the ones already running finish on the old one """
+    global SNAPSHOT
+    SNAPSHOT = snap
+    # cached results are keyed on the snapshot version and can't hit anymore, free them
+    SEARCH_CACHE.clear()
+    PAGE_CACHE.clear()
+
+
+def reload_snapshot():
+    """ loads the data files again and swaps them in. a failed load keeps the current snapshot """
+    t0 = time.time()
+    print('reloading the data files...')
+    try:
+        snap = load_snapshot()
+    except Exception as e:
+        print('reload failed, still serving snapshot %s:' % (SNAPSHOT.version, ), repr(e))
+        return False
+    swap_snapshot(snap)
+    print('now serving snapshot %s with %d papers, loaded in %.1fs' % (snap.version, len(snap.db), time.time() - t0))
+    return True
+
+
+def reload_watcher(interval):
+    """
+    background thread doing the reloads: right away when RELOAD_EVENT is set
+    (SIGHUP or /admin/reload), and when the data files changed and then stayed
+    the same for one more check, as the pipeline rewrites them one after the other
+    """
+    seen = SNAPSHOT.version
+    while True:
+        forced = RELOAD_EVENT.wait(interval if interval > 0 else None)
+        RELOAD_EVENT.clear()
+        version = snapshot_version()
+        if forced or (version != SNAPSHOT.version and version == seen):
+            reload_snapshot()
+        seen = version
+
+
 # -----------------------------------------------------------------------------
 # int main
 # -----------------------------------------------------------------------------
@@ -729,9 +1216,28 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--prod', dest='prod',
                         action='store_true', help='run in prod?')
     parser.add_argument('-r', '--num_results', dest='num_results', type=int,
-                        default=200, help='number of results to return per query')
+                        default=25, help='number of results to return per page')
     parser.add_argument('--port', dest='port', type=int,
                         default=5000, help='port to serve on')
+    parser.add_argument('--threads', dest='threads', type=int,
+                        default=8, help='number of threads running requests under --prod')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=1, help='number of processes serving under --prod, forked after loading the data')
+    parser.add_argument('--ann', dest='ann', action='store_true',
+                        help='find similar papers with the approximate index of make_ann.py')
+    parser.add_argument('--page-cache-size', dest='page_cache_size', type=int,
+                        default=500, help='number of rendered pages to keep for anonymous visitors')
+    parser.add_argument('--page-cache-ttl', dest='page_cache_ttl', type=int,
+                        default=300, help='seconds a cached page stays valid (tweets and time windows move)')
+    parser.add_argument('--library-cache-size', dest='library_cache_size', type=int,
+                        default=10000, help='number of user libraries to keep in memory')
+    parser.add_argument('--search-cache-size', dest='search_cache_size', type=int,
+                        default=1000, help='number of search queries to cache results of')
+    parser.add_argument('--search-cache-ttl', dest='search_cache_ttl', type=int,
+                        default=3600, help='seconds a cached search result stays valid')
+    parser.add_argument('--reload-interval', dest='reload_interval', type=int,
+                        default=60, help='seconds between checks for new data files to load, 0 to only '
+                        'reload on SIGHUP or /admin/reload')
     args = parser.parse_args()
     print(args)
 
@@ -740,28 +1246,40 @@ if __name__ == "__main__":
         print('this needs sqlite3 to be installed!')
         os.system('sqlite3 as.db < schema.sql')
 
-    print('loading the paper database', Config.db_serve_path)
-    db = pickle.load(open(Config.db_serve_path, 'rb'))
-
-    print('loading tfidf_meta', Config.meta_path)
-    meta = pickle.load(open(Config.meta_path, "rb"))
-    vocab = meta['vocab']
-    idf = meta['idf']
-
-    #print('loading paper similarities', Config.sim_path)
-    #sim_dict = pickle.load(open(Config.sim_path, "rb"))
-
-    print('loading user recommendations', Config.user_sim_path)
-    user_sim = {}
-    if os.path.isfile(Config.user_sim_path):
-        user_sim = pickle.load(open(Config.user_sim_path, 'rb'))
-
-    print('loading serve cache...', Config.serve_cache_path)
-    cache = pickle.load(open(Config.serve_cache_path, "rb"))
-    DATE_SORTED_PIDS = cache['date_sorted_pids']
-    TOP_SORTED_PIDS = cache['top_sorted_pids']
-    SEARCH_DICT = cache['search_dict']
+    SEARCH_CACHE = LRUCache(args.search_cache_size, ttl=args.search_cache_ttl)
+    LIBRARY_CACHE = LRUCache(args.library_cache_size)
+    USER_CACHE = LRUCache(args.library_cache_size)
+    PAGE_CACHE = LRUCache(args.page_cache_size, ttl=args.page_cache_ttl)
+    LIBRARY_LOCK = threading.RLock()
+    # changes to the libraries and discussions, shared with the other worker processes
+    LIBRARY_GENERATIONS = Generations(4096)
+    DISCUSSION_GENERATION = Generations()
+    SNAPSHOT = load_snapshot()
+
+    # new data files are loaded in the background and swapped in, see reload_watcher
+    RELOAD_EVENT = threading.Event()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: RELOAD_EVENT.set())
+
+    # the data is loaded once above and the workers share it, so this has to happen
+    # before any threads or connections are started. see prefork.py
+    SOCKETS = None
+    MASTER_PID = None
+    if args.prod and args.workers > 1:
+        from tornado.netutil import bind_sockets
+        from prefork import prefork
+        SOCKETS = bind_sockets(args.port)
+        WORKER = prefork(args.workers)
+        MASTER_PID = os.getppid()
+        metrics.CONST_LABELS['worker'] = str(WORKER)
+        print('worker %d (pid %d) starting' % (WORKER, os.getpid()))
+        # a worker forked after the pipeline ran starts on the master's older snapshot
+        if snapshot_version() != SNAPSHOT.version:
+            reload_snapshot()
+    threading.Thread(target=reload_watcher, args=(args.reload_interval, ), daemon=True).start()
     
+    # times and counts the mongodb commands for /metrics, of all clients made from here on
+    pymongo.monitoring.register(metrics.MongoListener())
     print('connecting to mongodb...')
     client = pymongo.MongoClient()
     mdb = client.arxiv
@@ -779,22 +1297,24 @@ if __name__ == "__main__":
     print('mongodb tags collection size:', tags_collection.estimated_document_count())
     print('mongodb goaway collection size:', goaway_collection.estimated_document_count())
     print('mongodb follow collection size:', follow_collection.estimated_document_count())
-    
+
+    # number of comments of every paper, see count_discussions
+    DISCUSSION_LOCK = threading.Lock()
+    count_discussions()
+    print('papers with discussions:', len(DISCUSSION_COUNTS))
+
     TAGS = ['insightful!', 'thank you', 'agree',
             'disagree', 'not constructive', 'troll', 'spam']
 
     # start
     if args.prod:
-        # run on Tornado instead, since running raw Flask in prod is not recommended
-        print('starting tornado!')
-        from tornado.wsgi import WSGIContainer
-        from tornado.httpserver import HTTPServer
-        from tornado.ioloop import IOLoop
-        from tornado.log import enable_pretty_logging
-        enable_pretty_logging()
-        http_server = HTTPServer(WSGIContainer(app))
-        http_server.listen(args.port)
-        IOLoop.instance().start()
+        # run on Tornado instead, since running raw Flask in prod is not recommended.
+        # requests run on a pool of threads and mongodb reads are prefetched async, see async_serve.py
+        print('starting tornado with %d threads!' % (args.threads, ))
+        from async_serve import serve_tornado
+        page_cached = [rule.rule for rule in app.url_map.iter_rules()
+                       if getattr(app.view_functions[rule.endpoint], 'page_cached', False)]
+        serve_tornado(app, args.port, args.threads, tags=TAGS, sockets=SOCKETS, page_cached=page_cached)
     else:
         print('starting flask!')
         app.debug = False
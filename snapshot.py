@@ -0,0 +1,401 @@
+"""
+the data serve.py answers from, written by make_cache.py as one snapshot that
+opens instantly instead of a set of pickles that have to be read in full.
+
+a snapshot is a directory of files plus a json manifest describing the tree
+of data stored in them. numpy arrays are .npy files that get memory mapped,
+long lists of strings are a blob with offsets, large str -> int dicts (term
+ids, the vocabulary) are looked up through a sorted array of key hashes, and
+small things are kept in the manifest itself. nothing is read until it is
+used, and the pages are shared by all the processes that map them.
+
+a new snapshot is written to a new directory and published by atomically
+replacing the manifest at Config.snapshot_path, so a reader always sees a
+complete one. the snapshot also holds what the server used to derive at
+startup: the tfidf matrix in search index order, the similar papers as rows
+of the paper store and the top papers with their publish times.
+"""
+
+import os
+import json
+import mmap
+import time
+import shutil
+import pickle
+from bisect import bisect_left
+
+import numpy as np
+
+from utils import Config, open_atomic, strip_version
+from paper_store import PaperStore, write_paper_store, key_hash
+from search_index import tfidf_matrix
+
+# lists and dicts up to this size are stored in the manifest
+INLINE_MAX = 1000
+# snapshot directories kept around, a running server may still use the previous one
+KEEP = 2
+
+
+def _map(path):
+    """ read-only memory map of a file, or b'' for an empty one (those can't be mapped) """
+    if os.path.getsize(path) == 0:
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _load_array(path):
+    a = np.load(path, mmap_mode='r')
+    return a if a.size else np.load(path)
+
+
+def _ints(a, fmt):
+    """ the array as a python sequence, indexing it is much cheaper than indexing numpy """
+    return memoryview(np.ascontiguousarray(a)).cast('B').cast(fmt) if len(a) else []
+
+
+class StringTable(object):
+    """ read-only list of strings, stored as one utf-8 blob and the offsets of every string """
+
+    def __init__(self, base):
+        self._offsets = _ints(_load_array(base + '.offsets.npy'), 'q')
+        self._blob = _map(base + '.blob')
+        self._n = max(len(self._offsets) - 1, 0)
+
+    @staticmethod
+    def write(strings, base):
+        blobs = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in blobs], out=offsets[1:])
+        np.save(base + '.offsets.npy', offsets)
+        with open(base + '.blob', 'wb') as f:
+            f.write(b''.join(blobs))
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._n))]
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError(i)
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(self._n))
+
+
+class StringMap(object):
+    """ read-only dict of str -> int, a key is found by bisecting the sorted hashes of the keys """
+
+    def __init__(self, base):
+        self._keys = StringTable(base + '.keys')
+        self._hashes = _ints(_load_array(base + '.hashes.npy'), 'Q')
+        self._rows = _ints(_load_array(base + '.rows.npy'), 'q')
+        self._values = _ints(_load_array(base + '.values.npy'), 'q')
+
+    @staticmethod
+    def write(d, base):
+        keys = list(d)
+        StringTable.write(keys, base + '.keys')
+        hashes = np.array([key_hash(k) for k in keys], dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        np.save(base + '.hashes.npy', hashes[order])
+        np.save(base + '.rows.npy', order.astype(np.int64))
+        np.save(base + '.values.npy', np.array([d[k] for k in keys], dtype=np.int64))
+
+    def _row(self, key):
+        h = key_hash(key)
+        p = bisect_left(self._hashes, h)
+        # almost always one candidate, more only on a hash collision
+        while p < len(self._hashes) and self._hashes[p] == h:
+            r = self._rows[p]
+            if self._keys[r] == key:
+                return r
+            p += 1
+        return -1
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return self._row(key) >= 0
+
+    def __getitem__(self, key):
+        r = self._row(key)
+        if r < 0:
+            raise KeyError(key)
+        return self._values[r]
+
+    def get(self, key, default=None):
+        r = self._row(key)
+        return default if r < 0 else self._values[r]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+
+class ArrayMap(object):
+    """ read-only dict of str -> 1d array, all arrays concatenated into one """
+
+    def __init__(self, base):
+        self._index = StringMap(base + '.index')
+        self._offsets = _ints(_load_array(base + '.offsets.npy'), 'q')
+        self._data = _load_array(base + '.data.npy')
+
+    @staticmethod
+    def write(d, base):
+        keys = list(d)
+        StringMap.write({k: i for i, k in enumerate(keys)}, base + '.index')
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(d[k]) for k in keys], out=offsets[1:])
+        np.save(base + '.offsets.npy', offsets)
+        np.save(base + '.data.npy', np.concatenate([np.asarray(d[k]) for k in keys]))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        i = self._index[key]
+        return self._data[self._offsets[i]:self._offsets[i + 1]]
+
+    def get(self, key, default=None):
+        return self[key] if key in self._index else default
+
+
+class ListMap(object):
+    """ read-only dict of int -> list of str, e.g. the recommended papers of every user id """
+
+    def __init__(self, base):
+        self._keys = _ints(_load_array(base + '.keys.npy'), 'q')
+        self._offsets = _ints(_load_array(base + '.offsets.npy'), 'q')
+        self._strings = StringTable(base + '.strings')
+
+    @staticmethod
+    def write(d, base):
+        keys = sorted(d)
+        np.save(base + '.keys.npy', np.array(keys, dtype=np.int64))
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(d[k]) for k in keys], out=offsets[1:])
+        np.save(base + '.offsets.npy', offsets)
+        StringTable.write([s for k in keys for s in d[k]], base + '.strings')
+
+    def _pos(self, key):
+        p = bisect_left(self._keys, key)
+        return p if p < len(self._keys) and self._keys[p] == key else -1
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return self._pos(key) >= 0
+
+    def __getitem__(self, key):
+        p = self._pos(key)
+        if p < 0:
+            raise KeyError(key)
+        return self._strings[self._offsets[p]:self._offsets[p + 1]]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+def _all(xs, types):
+    return all(isinstance(x, types) for x in xs)
+
+
+def _json_default(x):
+    # numpy scalars, e.g. the term ids of the sklearn vocabulary
+    if isinstance(x, np.integer):
+        return int(x)
+    if isinstance(x, np.floating):
+        return float(x)
+    raise TypeError('%r can not be stored in a snapshot' % (x, ))
+
+
+def write_tree(obj, dirpath, name):
+    """ writes obj into files of dirpath named after name, returns its manifest node """
+    base = os.path.join(dirpath, name)
+    if isinstance(obj, np.ndarray):
+        if not obj.size:
+            return {'empty': [obj.dtype.str, list(obj.shape)]}
+        np.save(base + '.npy', obj)
+        return {'npy': name}
+    if isinstance(obj, PaperStore):
+        raise ValueError('paper stores are written with write_paper_store')
+    if isinstance(obj, dict):
+        keys, values = list(obj), list(obj.values())
+        if obj and _all(keys, str) and _all(values, (int, np.integer)) and len(obj) > INLINE_MAX:
+            StringMap.write(obj, base)
+            return {'strmap': name}
+        if obj and _all(keys, str) and _all(values, np.ndarray):
+            ArrayMap.write(obj, base)
+            return {'arraymap': name}
+        if obj and _all(keys, int) and _all(values, list):
+            ListMap.write(obj, base)
+            return {'listmap': name}
+        if _all(keys, str) and not _all(values, (int, float, str, np.integer, np.floating)):
+            return {'dict': {k: write_tree(v, dirpath, '%s.%s' % (name, k)) for k, v in obj.items()}}
+    if isinstance(obj, list) and len(obj) > INLINE_MAX and _all(obj, str):
+        StringTable.write(obj, base)
+        return {'strings': name}
+    # anything else is small (or has to be), and goes into the manifest as json
+    return {'value': obj}
+
+
+def load_tree(node, dirpath):
+    """ the data of a manifest node, memory mapped where it is stored in a file """
+    kind, arg = next(iter(node.items()))
+    if kind == 'value':
+        return arg
+    if kind == 'dict':
+        return {k: load_tree(v, dirpath) for k, v in arg.items()}
+    if kind == 'empty':
+        return np.zeros(arg[1], dtype=arg[0])
+    base = os.path.join(dirpath, arg)
+    if kind == 'npy':
+        return np.load(base + '.npy', mmap_mode='r')
+    if kind == 'store':
+        return PaperStore(base)
+    cls = {'strings': StringTable, 'strmap': StringMap, 'arraymap': ArrayMap, 'listmap': ListMap}[kind]
+    return cls(base)
+
+
+def serve_tree(db, cache, meta, order):
+    """
+    what serve.py uses, from the outputs of make_cache.py (db, cache) and
+    analyze.py (meta), tfidf.p, sim.npz and user_sim.p. order is the row
+    order of the paper store
+    """
+    tree = {
+        'date_sorted_pids': cache['date_sorted_pids'],
+        'search_index': cache['search_index'],
+        'prefix_index': cache['prefix_index'],
+        'vocab': meta['vocab'],
+        'idf': np.asarray(meta['idf']),
+    }
+    # /top filters these by age on every request, so their publish times go along
+    top = [p for p in cache['top_sorted_pids'] if p in db]
+    tree['top_sorted_pids'] = top
+    tree['top_published'] = np.array([db[p]['time_published'] for p in top], dtype=np.int64)
+
+    if os.path.isfile(Config.tfidf_path):
+        print('moving the tfidf matrix into search index order', Config.tfidf_path)
+        X = pickle.load(open(Config.tfidf_path, 'rb'))['X']
+        # older tfidf_meta.p files don't list the db key of every row, so we recover it from the pids
+        keys = meta.get('keys') or [p if p in db else strip_version(p) for p in meta['pids']]
+        X = tfidf_matrix(X, keys, cache['search_index']['pids'])
+        tree['tfidf'] = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr,
+                         'shape': np.array(X.shape, dtype=np.int64)}
+
+    if os.path.isfile(Config.sim_path):
+        tree['sim'] = sim_rows(order)
+    tree['user_sim'] = user_sim()
+    return tree
+
+
+def sim_rows(order):
+    """ the similar papers of sim.npz as rows of a paper store with its keys in order """
+    print('moving the similar papers into paper store rows', Config.sim_path)
+    store_row = {k: i for i, k in enumerate(order)}
+    with np.load(Config.sim_path) as f:
+        idx, keys = f['idx'], f['keys'].tolist()
+    to_row = np.array([store_row.get(k, -1) for k in keys] + [-1], dtype=np.int32)
+    sim = np.full((len(order), idx.shape[1]), -1, dtype=np.int32)
+    have = [i for i, k in enumerate(keys) if k in store_row]
+    # -1 padding of make_sim.py stays -1, papers we don't serve become -1 too
+    sim[[store_row[keys[i]] for i in have]] = to_row[idx[have]]
+    return sim
+
+
+def user_sim():
+    """ the recommendations of buildsvm.py, none if it never ran """
+    if not os.path.isfile(Config.user_sim_path):
+        return {}
+    return pickle.load(open(Config.user_sim_path, 'rb'))
+
+
+def _new_dir():
+    """ (version, directory name, path) of a new snapshot """
+    version = time.strftime('%Y%m%d-%H%M%S') + '-%d' % (os.getpid(), )
+    dirname = 'snapshot-' + version
+    dirpath = os.path.join(os.path.dirname(Config.snapshot_path), dirname)
+    os.makedirs(dirpath)
+    return version, dirname, dirpath
+
+
+def _publish(version, dirname, nodes):
+    """ makes the snapshot in dirname the current one, and removes the old ones """
+    with open_atomic(Config.snapshot_path, 'w') as f:
+        json.dump({'version': version, 'dir': dirname, 'tree': nodes}, f, default=_json_default)
+
+    # the previous one may still be used by a server that hasn't reloaded yet
+    parent = os.path.dirname(Config.snapshot_path)
+    old = sorted(d for d in os.listdir(parent) if d.startswith('snapshot-') and d != dirname)
+    for d in old[:max(len(old) - (KEEP - 1), 0)]:
+        shutil.rmtree(os.path.join(parent, d), ignore_errors=True)
+
+
+def write_snapshot(db, cache, meta):
+    """ writes a new snapshot into a new directory and publishes it, returns its version """
+    order = cache['date_sorted_pids']
+    version, dirname, dirpath = _new_dir()
+    print('writing the paper store')
+    write_paper_store(db, os.path.join(dirpath, 'papers.store'), order=order)
+    tree = serve_tree(db, cache, meta, order)
+    print('writing snapshot', dirpath)
+    nodes = {k: write_tree(v, dirpath, k) for k, v in tree.items()}
+    nodes['db'] = {'store': 'papers.store'}
+    _publish(version, dirname, nodes)
+    return version
+
+
+def republish_snapshot(names):
+    """
+    publishes a copy of the current snapshot with the parts in names ('sim',
+    'user_sim') made again from sim.npz and user_sim.p, for make_sim.py and
+    buildsvm.py when they run after make_cache.py. the files of the other parts
+    are hard links to the ones of the current snapshot. returns the new
+    version, or None if there is no snapshot yet
+    """
+    if not os.path.isfile(Config.snapshot_path):
+        return None
+    manifest = json.load(open(Config.snapshot_path))
+    olddir = os.path.join(os.path.dirname(Config.snapshot_path), manifest['dir'])
+    version, dirname, dirpath = _new_dir()
+    # the files of a part are named after it. the replaced ones are written anew, writing
+    # over a link would change the files the running servers have mapped
+    for fname in os.listdir(olddir):
+        if not any(fname.startswith(name + '.') for name in names):
+            os.link(os.path.join(olddir, fname), os.path.join(dirpath, fname))
+    nodes = dict(manifest['tree'])
+    if 'sim' in names:
+        nodes.pop('sim', None)
+        if os.path.isfile(Config.sim_path):
+            order = list(PaperStore(os.path.join(olddir, nodes['db']['store'])).keys())
+            nodes['sim'] = write_tree(sim_rows(order), dirpath, 'sim')
+    if 'user_sim' in names:
+        nodes['user_sim'] = write_tree(user_sim(), dirpath, 'user_sim')
+    _publish(version, dirname, nodes)
+    return version
+
+
+def snapshot_dir():
+    """ directory of the current snapshot """
+    manifest = json.load(open(Config.snapshot_path))
+    return os.path.join(os.path.dirname(Config.snapshot_path), manifest['dir'])
+
+
+def load_snapshot_tree():
+    """ (version, data) of the current snapshot, nothing is read from the files yet """
+    manifest = json.load(open(Config.snapshot_path))
+    dirpath = os.path.join(os.path.dirname(Config.snapshot_path), manifest['dir'])
+    return manifest['version'], {k: load_tree(v, dirpath) for k, v in manifest['tree'].items()}
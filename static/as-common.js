@@ -76,6 +76,28 @@ function strip_version(pidv) {
     return lst[0];
 }
 
+// fetches the next page of the current view from the server (?start= cursor) and
+// appends it to papers. next_start is passed in from flask, null on the last page
+var next_start = null;
+var loading_page = false;
+function fetchMorePapers(callback) {
+    if (next_start === null || loading_page) { return; }
+    loading_page = true;
+    var params = { start: next_start, format: 'json' };
+    for (var k in QueryString) {
+        if (k !== '' && k !== 'start' && typeof QueryString[k] === 'string') {
+            params[k] = QueryString[k].replace(/\+/g, ' ');
+        }
+    }
+    $.getJSON(window.location.pathname, params, function (data) {
+        papers = papers.concat(data.papers);
+        $.extend(pid_to_users, data.pid_to_users);
+        next_start = data.next_start;
+        loading_page = false;
+        if (callback) { callback(); }
+    }).fail(function () { loading_page = false; });
+}
+
 // populate papers into #rtable
 // we have some global state here, which is gross and we should get rid of later.
 var pointer_ix = 0; // points to next paper in line to be added to #rtable
@@ -89,6 +111,12 @@ function addPapers(num, dynamic) {
     for (var i = 0; i < num; i++) {
         var ix = base_ix + i;
         if (ix >= papers.length) {
+            if (next_start !== null) {
+                // we ran out of papers on this page, get the next one and keep going
+                var left = num - i;
+                fetchMorePapers(function () { addPapers(left, true); });
+                return false;
+            }
             if (!showed_end_msg) {
                 if (ix >= numresults) {
                     var msg = 'Results complete.';
@@ -229,7 +257,53 @@ function addPapers(num, dynamic) {
         }
     }
 
-    return pointer_ix >= papers.length; // are we done?
+    return pointer_ix >= papers.length && next_start === null; // are we done?
+}
+
+// facet filters (venue, year, source) with their counts, passed in from flask.
+// clicking a value narrows the current view to it, clicking it again removes the filter
+function addFacets(facets) {
+    var root = d3.select('#facets');
+    var names = ['venue', 'year', 'source'];
+    for (var i = 0; i < names.length; i++) {
+        var name = names[i];
+        if (!facets.hasOwnProperty(name) || facets[name].length === 0) { continue; }
+        var fdiv = root.append('div').classed('facet', true);
+        fdiv.append('span').classed('facet-name', true).text(name + ':');
+        for (var j = 0; j < facets[name].length; j++) {
+            var value = String(facets[name][j][0]);
+            var count = facets[name][j][1];
+            var params = {};
+            for (var k in QueryString) {
+                if (k !== '' && k !== 'start' && typeof QueryString[k] === 'string') {
+                    params[k] = QueryString[k].replace(/\+/g, ' ');
+                }
+            }
+            var selected = params[name] === value;
+            if (selected) { delete params[name]; } else { params[name] = value; }
+            fdiv.append('a').attr('href', window.location.pathname + '?' + $.param(params))
+                .classed('facet-value', true).classed('facet-selected', selected)
+                .text(value + ' (' + count + ')');
+        }
+    }
+}
+
+// typeahead for the search box: fills a <datalist> from /autocomplete on every keystroke
+function setupAutocomplete(input_selector, datalist_selector) {
+    var seq = 0; // only the response to the latest keystroke gets rendered
+    $(input_selector).on('input', function () {
+        var q = $(this).val();
+        var myseq = ++seq;
+        if (q.length === 0 || q.charAt(0) === '"') { return; } // nothing typed, or a completion was just picked
+        $.getJSON('/autocomplete', { q: q }, function (data) {
+            if (myseq !== seq) { return; } // stale
+            var dl = d3.select(datalist_selector);
+            dl.selectAll('option').remove();
+            for (var i = 0; i < data.length; i++) {
+                dl.append('option').attr('value', data[i].q).attr('label', data[i].kind);
+            }
+        });
+    });
 }
 
 function timeConverter(UNIX_timestamp) {
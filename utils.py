@@ -1,4 +1,5 @@
 from contextlib import contextmanager
+from collections import OrderedDict
 
 import os
 import re
@@ -8,7 +9,9 @@ import requests
 import random
 import time
 import json
+import threading
 import dateutil.parser
+import numpy as np
 
 # global settings
 # -----------------------------------------------------------------------------
@@ -27,12 +30,21 @@ class Config(object):
     # intermediate pickles
     tfidf_path = './data/runtime/tfidf.p'
     meta_path = './data/runtime/tfidf_meta.p'
-    sim_path = './data/runtime/sim_dict.p'
+    sim_path = './data/runtime/sim.npz'  # written by make_sim.py
+    ann_path = './data/runtime/ann.p'  # written by make_ann.py
+    # LSA embeddings written by make_lsa.py, raw .npy files so they can be memory mapped
+    lsa_path = './data/runtime/lsa.npy'
+    lsa_int8_path = './data/runtime/lsa_int8.npy'
+    lsa_meta_path = './data/runtime/lsa_meta.p'
     user_sim_path = './data/runtime/user_sim.p'
     # sql database file
     # an enriched db.p with various preprocessing info
     db_serve_path = './data/runtime/db2.p'
+    # what serve.py reads, written by make_cache.py: the manifest of the current snapshot, see snapshot.py
+    snapshot_path = './data/runtime/snapshot.json'
     database_path = './data/runtime/as.db'
+    # on demand profiles of single requests of serve.py, see profiler.py
+    profile_dir = './data/profiles'
     serve_cache_path = './data/runtime/serve_cache.p'
 
     # do we beg the active users randomly for money? 0 = no.
@@ -108,6 +120,100 @@ def safe_pickle_dump(obj, fname):
         pickle.dump(obj, f, -1)
 
 
+# caching utils
+# -----------------------------------------------------------------------------
+
+class LRUCache(object):
+    """
+    thread safe mapping holding at most maxsize entries, evicting the least
+    recently used one. if ttl (in seconds) is given entries also expire.
+    keeps hit/miss counters so the server can report how well it does.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (time stored, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self.data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time(), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            return None if entry is None else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self.data)
+
+
+def process_memory(pid='self'):
+    """
+    (uss, pss) of a process in MB: the memory only it uses, and its share of
+    the memory it shares with others. read from /proc so linux only, None elsewhere
+    """
+    out = {}
+    try:
+        with open('/proc/%s/smaps_rollup' % (pid, )) as f:
+            for line in f:
+                parts = line.split()
+                if parts[0] in ('Private_Clean:', 'Private_Dirty:', 'Pss:'):
+                    out[parts[0]] = out.get(parts[0], 0) + int(parts[1])
+    except OSError:
+        return None
+    return (out['Private_Clean:'] + out['Private_Dirty:']) / 1024, out['Pss:'] / 1024
+
+
+# embedding utils
+# -----------------------------------------------------------------------------
+
+def load_lsa(int8=False):
+    """
+    returns the LSA embeddings of make_lsa.py as a read only memory map, so
+    processes using them share the pages, and their meta: the db key of every
+    row in 'keys', key -> row in 'ptoi' and the int8 row scales in 'scale'.
+    """
+    meta = pickle.load(open(Config.lsa_meta_path, 'rb'))
+    E = np.load(Config.lsa_int8_path if int8 else Config.lsa_path, mmap_mode='r')
+    return E, meta
+
+
+def lsa_dense(E, meta, rows=slice(None)):
+    """ the given rows of the embeddings as float32, dequantizing the int8 variant """
+    if E.dtype == np.int8:
+        return E[rows].astype(np.float32) * meta['scale'][rows, None]
+    return np.asarray(E[rows], dtype=np.float32)
+
+
 # arxiv utils
 # -----------------------------------------------------------------------------
 
@@ -237,4 +343,43 @@ def flatten(l):
             res += flatten(each)
         return res
     else:
-        return [l]
\ No newline at end of file
+        return [l]
+
+
+def paper_display(p, timestruct=None):
+    """
+    the fields of a paper the frontend shows that never change, computed once
+    by make_cache.py and stored as p['_display'] so serve.encode_json only
+    has to add the per user and dynamic ones. timestruct is the parsed
+    p['published'] if the caller already has it.
+    """
+    if '_rawid' in p:
+        idvv = '%sv%d' % (p['_rawid'], p['_version'])
+    else:
+        idvv = p['url'].replace('/','').replace(':','')
+    d = {}
+    d['title'] = p['title']
+    d['pid'] = idvv
+    d['rawpid'] = p.get('_rawid','')
+    if 'authors' in p:
+        d['authors'] = [a['name'] for a in p['authors']]
+    else:
+        d['authors'] = p['author']
+    d['affiliation'] = '; '.join(list(set(flatten(p.get('affiliation', [])))))
+    d['link'] = p['link'] if 'link' in p else p['url']
+    d['abstract'] = p.get('summary', '')
+    d['conf_full_name'] = p.get('conf_full_name', 'arXiv')
+    if len(d['conf_full_name']) > 24:
+        d['conf_full_name_trunc'] = d['conf_full_name'][:24]+'...'
+    else:
+        d['conf_full_name_trunc'] = d['conf_full_name']
+    # render time information nicely
+    if timestruct is None:
+        timestruct = parse_time(p.get('published',Config.default_published_time))
+    d['published_time'] = '%s/%s/%s' % (timestruct.month, timestruct.day, timestruct.year)
+    # arxiv comments from the authors (when they submit the paper)
+    cc = p.get('arxiv_comment', '')
+    if len(cc) > 100:
+        cc = cc[:100] + '...'  # crop very long comments
+    d['comment'] = cc
+    return d